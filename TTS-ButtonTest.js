@@ -1,8 +1,8 @@
 // ==UserScript==
-// @name         TTS - Button Test (v1.2 - Korrigiert)
+// @name         TTS - Button Test (v1.3 - Sitzung)
 // @namespace    http://tampermonkey.net/
-// @version      1.2
-// @description  Fügt einen Button hinzu, um die TTS-Server-Verbindung zu testen.
+// @version      1.3
+// @description  Fügt Buttons hinzu, um die TTS-Server-Verbindung und das Vorlesen während des Schreibens zu testen.
 // @author       Test
 // @match        https://www.google.com/*
 // @match        https://sl5.de/*
@@ -14,7 +14,7 @@
 (function() {
     'use strict'; // <-- TIPPFEHLER KORRIGIERT
 
-    console.log('[TTS Button Test v1.2] Skript wird ausgeführt.');
+    console.log('[TTS Button Test v1.3] Skript wird ausgeführt.');
 
     const testButton = document.createElement('button');
     testButton.textContent = 'Sage "Hallo Welt"';
@@ -30,26 +30,74 @@
     testButton.style.cursor = 'pointer';
 
     testButton.addEventListener('click', () => {
-        console.log('[TTS Button Test v1.2] Button geklickt. Sende "Hallo Welt" zum Server...');
+        console.log('[TTS Button Test v1.3] Button geklickt. Sende "Hallo Welt" zum Server...');
         const textToSend = 'Hallo Welt, dieser Test funktioniert.';
 
         GM_xmlhttpRequest({
             method: 'POST',
             url: 'https://localhost:5002/speak',
-            data: JSON.stringify({ text: textToSend }),
+            // Reiner Text: die teure Markdown/Pygments/BeautifulSoup-Stufe überspringen
+            data: JSON.stringify({ text: textToSend, skip_stages: ['libraries'] }),
                           headers: { 'Content-Type': 'application/json' },
                           onload: function(response) {
-                              console.log('[TTS Button Test v1.2] Server-Antwort:', response.responseText);
+                              console.log('[TTS Button Test v1.3] Server-Antwort:', response.responseText);
                               alert('Anfrage an den Server gesendet! Status: ' + response.status);
                           },
                           onerror: function(response) {
-                              console.error('[TTS Button Test v1.2] Server-Fehler-Details:', response);
+                              console.error('[TTS Button Test v1.3] Server-Fehler-Details:', response);
                               alert('FEHLER! Details aus dem Fehler-Objekt:\n\n' + JSON.stringify(response, null, 2));
                           }
         });
     });
 
+    // Zweiter Button: schickt einen Text stückweise an eine Sitzung (/sessions), wie eine
+    // Antwort, die gerade geschrieben wird. Der erste Satz sollte schon vor dem Ende zu hören sein.
+    const sessionButton = testButton.cloneNode();
+    sessionButton.textContent = 'Sitzung testen';
+    sessionButton.style.top = '70px';
+    sessionButton.style.backgroundColor = '#2196F3'; // Blau
+
+    const postJson = (url, payload, onload) => {
+        GM_xmlhttpRequest({
+            method: 'POST',
+            url: url,
+            data: JSON.stringify(payload),
+                          headers: { 'Content-Type': 'application/json' },
+                          onload: onload,
+                          onerror: function(response) {
+                              console.error('[TTS Button Test v1.3] Server-Fehler-Details:', response);
+                              alert('FEHLER! Details aus dem Fehler-Objekt:\n\n' + JSON.stringify(response, null, 2));
+                          }
+        });
+    };
+
+    sessionButton.addEventListener('click', () => {
+        const pieces = ['Das ist der erste Satz, ', 'er wird schon gesprochen, ', 'während der Rest noch kommt. ',
+                        'Und das ist der zweite ', 'und letzte Satz.'];
+        postJson('https://localhost:5002/sessions', { skip_stages: ['libraries'] }, function(response) {
+            if (response.status !== 201) {
+                alert('Sitzung abgelehnt! Status: ' + response.status);
+                return;
+            }
+            const sessionUrl = 'https://localhost:5002/sessions/' + JSON.parse(response.responseText).session_id;
+            console.log('[TTS Button Test v1.3] Sitzung geöffnet:', sessionUrl);
+            let offset = 0;
+            const sendNext = (index) => {
+                const piece = pieces[index];
+                postJson(sessionUrl, { text: piece, offset: offset, final: index === pieces.length - 1 }, function(reply) {
+                    console.log('[TTS Button Test v1.3] Sitzung:', reply.responseText);
+                    offset += piece.length;
+                    if (index + 1 < pieces.length) {
+                        setTimeout(() => sendNext(index + 1), 700);
+                    }
+                });
+            };
+            sendNext(0);
+        });
+    });
+
     document.body.appendChild(testButton);
-    console.log('[TTS Button Test v1.2] Button wurde zur Seite hinzugefügt.');
+    document.body.appendChild(sessionButton);
+    console.log('[TTS Button Test v1.3] Buttons wurden zur Seite hinzugefügt.');
 
 })();
@@ -1,28 +1,29 @@
-import subprocess
-import time
-from pathlib import Path
+import json
 import os
-import requests
+import socket
 
 
 content = clipboard.get_clipboard()
-with open('/tmp/speak_server_input.txt', 'w') as f:
-    f.write(content)
-time.sleep(0.2)
 
 # --- Server Configuration ---
-HOST = '127.0.0.1'
-PORT = 5002
-HTTPS_URL = f"https://{HOST}:{PORT}/speak"
-HTTP_URL = f"http://{HOST}:{PORT}/speak"
+RUNTIME_DIR = os.environ.get('XDG_RUNTIME_DIR', '/tmp')
+SOCKET_PATH = os.path.join(RUNTIME_DIR, 'speak_server.sock')
+ENDPOINT_FILE = os.path.join(RUNTIME_DIR, 'speak_server.json')
 # ---
 
-try:
-    requests.head(HTTPS_URL, verify=False, timeout=1)
-    url_to_use = HTTPS_URL
-except requests.exceptions.RequestException:
-    requests.head(HTTP_URL, timeout=1)
-    url_to_use = HTTP_URL
-
-response = requests.post(url_to_use, verify=False)
+# Clipboard text is spoken as it is, without the server's cleaning stages
+payload = {'text': content, 'stages': []}
 
+try:
+    # Fast path: the server's local socket, no HTTP round trips
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(5)
+        sock.connect(SOCKET_PATH)
+        sock.sendall((json.dumps(payload) + '\n').encode('utf-8'))
+        sock.makefile('r', encoding='utf-8').readline()
+except OSError:
+    # Socket disabled: use the URL the server announced at startup
+    import requests
+    with open(ENDPOINT_FILE, 'r') as f:
+        url_to_use = f"{json.load(f)['url']}/speak"
+    response = requests.post(url_to_use, json=payload, verify=False)
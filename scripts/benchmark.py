@@ -0,0 +1,223 @@
+# benchmark.py
+"""
+Offline benchmark of the speak pipeline.
+
+Times every cleaning stage, the whole cleaning pipeline, create_slug,
+language detection and end-to-end /speak requests on the corpus in
+scripts/benchmark_corpus/. Piper is replaced by a stub voice and the audio
+goes to the null sink, so the numbers show the server's own overhead and
+the run needs no sound card.
+The result is JSON, to compare runs across commits:
+
+    python scripts/benchmark.py --output bench-$(git rev-parse --short HEAD).json
+    python scripts/benchmark.py --compare bench-1a2b3c4.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# --- Find project root from this script's location ---
+SCRIPT_DIR = Path(__file__).resolve().parent
+PROJECT_ROOT = SCRIPT_DIR.parent
+CORPUS_DIR = SCRIPT_DIR / 'benchmark_corpus'
+# ---
+
+# --- Benchmark Configuration ---
+# How often each case runs (after one untimed warm-up run)
+DEFAULT_REPEAT = 20
+# The corpus is also concatenated into one document of this many characters
+LONG_DOCUMENT_CHARS = 300_000
+# The stub voice returns this much silence per character (roughly real speech speed)
+STUB_SAMPLE_RATE = 22050
+STUB_SECONDS_PER_CHAR = 0.06
+# End-to-end throughput: how many jobs are queued at once
+THROUGHPUT_JOBS = 50
+# ---
+
+
+class StubVoice:
+    """
+    Stands in for piper.PiperVoice: returns silence proportional to the
+    text length, one piece per line, without running a model.
+    """
+
+    class config:
+        sample_rate = STUB_SAMPLE_RATE
+
+    @classmethod
+    def load(cls, model_path):
+        return cls()
+
+    def synthesize_stream_raw(self, text):
+        for line in text.split('\n'):
+            yield bytes(2 * int(len(line) * STUB_SECONDS_PER_CHAR * STUB_SAMPLE_RATE))
+
+
+def import_server():
+    """Imports speak_server without archive, cache, socket, sound or dedup, with the stub voice."""
+    sys.argv = ['speak_server.py', '--no-save', '--cache-size-mb=0', '--socket=', '--audio-sink=null',
+                '--dedup-window=0']
+    sys.path.insert(0, str(PROJECT_ROOT))
+    import speak_server
+    speak_server.PiperVoice = StubVoice
+    return speak_server
+
+
+def load_corpus() -> dict:
+    corpus = {path.stem: path.read_text(encoding='utf-8') for path in sorted(CORPUS_DIR.glob('*.md'))}
+    joined = '\n\n'.join(corpus.values())
+    corpus['long_document'] = (joined * (LONG_DOCUMENT_CHARS // len(joined) + 1))[:LONG_DOCUMENT_CHARS]
+    return corpus
+
+
+def measure(func, repeat: int) -> dict:
+    """Runs `func` once untimed, then `repeat` times; returns the timings in ms."""
+    func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "unit": "ms",
+        "runs": repeat,
+        "min": round(timings[0], 4),
+        "median": round(statistics.median(timings), 4),
+        "mean": round(statistics.fmean(timings), 4),
+        "p95": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 4),
+        "stdev": round(statistics.stdev(timings), 4) if len(timings) > 1 else 0.0,
+    }
+
+
+def git_revision() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=PROJECT_ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return {"commit": commit, "dirty": dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def bench_cleaning(server, corpus, repeat, results):
+    for doc_name, text in corpus.items():
+        for stage_name, stage in server.CLEANING_STAGES.items():
+            results[f"clean/{stage_name}/{doc_name}"] = {**measure(lambda: stage(text), repeat), "chars": len(text)}
+        results[f"clean/all/{doc_name}"] = {**measure(lambda: server.clean_for_tts(text), repeat), "chars": len(text)}
+        cleaned = server.clean_for_tts(text)
+        results[f"create_slug/{doc_name}"] = measure(lambda: server.create_slug(cleaned, min_word_len=5), repeat)
+
+
+def bench_language_detection(server, corpus, repeat, results, skipped):
+    # Without the memo, so every run really asks the model
+    detector = server.LanguageDetector(server._load_language_model, server.MODELS, cache_size=0)
+    try:
+        detector.model
+    except Exception as e:
+        skipped["detect"] = f"language model could not be loaded: {e}"
+        return
+    for doc_name, text in corpus.items():
+        cleaned = server.clean_for_tts(text)
+        results[f"detect/{doc_name}"] = measure(lambda: detector.detect(cleaned), repeat)
+        sentences = server.split_sentences(cleaned, min_chars=0)
+        results[f"detect_many/{doc_name}"] = {**measure(lambda: detector.detect_many(sentences), repeat),
+                                              "sentences": len(sentences)}
+
+
+def bench_speak(server, corpus, repeat, results):
+    client = server.app.test_client()
+
+    def speak(text, wait):
+        response = client.post('/speak', json={"text": text, "wait": wait})
+        if response.status_code not in (200, 202):
+            raise RuntimeError(f"/speak answered {response.status_code}: {response.get_json()}")
+        return response.get_json()
+
+    documents = {name: text for name, text in corpus.items() if name != 'long_document'}
+    for doc_name, text in documents.items():
+        results[f"speak/latency/{doc_name}"] = measure(lambda: speak(text, True), repeat)
+
+    texts = list(documents.values())
+    start = time.perf_counter()
+    job_ids = [speak(texts[i % len(texts)], False)["job_id"] for i in range(THROUGHPUT_JOBS)]
+    for job_id in job_ids:
+        server.job_scheduler.get(job_id).done.wait()
+    elapsed = time.perf_counter() - start
+    results["speak/throughput"] = {"unit": "jobs/s", "jobs": THROUGHPUT_JOBS,
+                                   "value": round(THROUGHPUT_JOBS / elapsed, 3)}
+
+
+def compare(baseline: dict, current: dict):
+    """Prints the change of every median against `baseline`."""
+    print(f"{'Case':<55} {'before':>10} {'after':>10} {'change':>8}")
+    for name, result in current["results"].items():
+        old = baseline["results"].get(name)
+        key = "median" if "median" in result else "value"
+        if not old or key not in old or not old[key]:
+            continue
+        change = (result[key] - old[key]) / old[key] * 100
+        print(f"{name:<55} {old[key]:>10.3f} {result[key]:>10.3f} {change:>+7.1f}%")
+
+
+parser = argparse.ArgumentParser(description='Offline benchmark of the speak pipeline.')
+parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                    help=f"Timed runs per case (default: {DEFAULT_REPEAT}).")
+parser.add_argument('--only', choices=['clean', 'detect', 'speak'], action='append',
+                    help="Only run these groups (can be given several times).")
+parser.add_argument('--output', help="Write the JSON result to this file instead of stdout.")
+parser.add_argument('--compare', metavar='BASELINE', help="Compare against an earlier JSON result.")
+parser.add_argument('--verbose', action='store_true', help="Show the server's own output.")
+args = parser.parse_args()
+groups = args.only or ['clean', 'detect', 'speak']
+
+corpus = load_corpus()
+results = {}
+skipped = {}
+# The server prints a lot per request; keep stdout clean for the JSON
+server_output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+with server_output:
+    server = import_server()
+    if 'clean' in groups:
+        bench_cleaning(server, corpus, args.repeat, results)
+    if 'detect' in groups:
+        bench_language_detection(server, corpus, args.repeat, results, skipped)
+    if 'speak' in groups:
+        bench_speak(server, corpus, args.repeat, results)
+
+report = {
+    "meta": {
+        **git_revision(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "corpus": {name: len(text) for name, text in corpus.items()},
+        "language_model": server.MODEL_PATH,
+        "synthesizer": "stub",
+        "audio_sink": "null",
+    },
+    "results": results,
+    "skipped": skipped,
+}
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+elif not args.compare:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+if args.compare:
+    with open(args.compare) as f:
+        compare(json.load(f), report)
@@ -1,7 +1,9 @@
 # speak_file.py
 import argparse
+import codecs
+import json
+import socket
 import subprocess
-import requests
 import time
 import os
 import sys
@@ -13,10 +15,27 @@ START_SERVER_SCRIPT = os.path.join(PROJECT_ROOT, 'scripts', 'activate-venv_and_r
 # ---
 
 # --- Server Configuration ---
-HOST = '127.0.0.1'
-PORT = 5002
-HTTPS_URL = f"https://{HOST}:{PORT}/speak"
-HTTP_URL = f"http://{HOST}:{PORT}/speak"
+RUNTIME_DIR = os.environ.get('XDG_RUNTIME_DIR', '/tmp')
+# Local socket of the server, see SOCKET_PATH in speak_server.py
+SOCKET_PATH = os.path.join(RUNTIME_DIR, 'speak_server.sock')
+# The server writes its URL, socket and pid here at startup, see ENDPOINT_FILE in speak_server.py
+ENDPOINT_FILE = os.path.join(RUNTIME_DIR, 'speak_server.json')
+# How long to wait for a freshly started server (seconds)
+MAX_WAIT_TIME = 10
+# ---
+
+# --- Incremental Mode ---
+# Paragraphs are collected into requests of about this many characters
+INCREMENTAL_CHUNK_CHARS = 1500
+# A paragraph longer than this is split at a line break, a line longer than this anywhere
+INCREMENTAL_MAX_CHUNK_CHARS = 6000
+# How many requests may wait at the server while one is being spoken
+INCREMENTAL_AHEAD = 2
+# How far each file got, for --resume
+PROGRESS_FILE = os.path.join(
+    os.environ.get('XDG_STATE_HOME', os.path.expanduser('~/.local/state')), 'speak_file', 'progress.json')
+# Job states after which the server won't touch a job again
+FINAL_STATES = ('done', 'error', 'cancelled', 'dropped', 'rejected')
 # ---
 
 # Initialize the parser
@@ -40,6 +59,32 @@ parser.add_argument(
     metavar='FILENAME'
 )
 
+parser.add_argument(
+    '--parallel',
+    action='store_true',
+    help='Let the server synthesize long texts on all CPU cores at once'
+)
+
+parser.add_argument(
+    '--incremental',
+    action='store_true',
+    help='Send the file paragraph by paragraph while it is being spoken, for very large files'
+)
+
+parser.add_argument(
+    '--offset',
+    type=int,
+    default=None,
+    metavar='BYTES',
+    help='Start reading at this byte offset (implies --incremental)'
+)
+
+parser.add_argument(
+    '--resume',
+    action='store_true',
+    help='Continue where the last incremental run of this file stopped (implies --incremental)'
+)
+
 
 
 # Parse the arguments from the command line
@@ -49,9 +94,16 @@ args = parser.parse_args()
 # --- Main Logic ---
 content = 'None'
 # connect = ''
+incremental = args.incremental or args.offset is not None or args.resume
+if incremental and not args.file:
+    print("Error: --incremental, --offset and --resume need a file.")
+    sys.exit(1)
 
 # Check if a filename was provided on the command line
-if args.file:
+if incremental:
+    # The file is read piece by piece further down
+    pass
+elif args.file:
     # A filename was provided, so we try to open it
     try:
         with open(args.file, 'r') as f:
@@ -72,58 +124,263 @@ else:
     content = 'Hello! Aou also could send text-files to me'
 
 
-with open('/tmp/speak_server_input.txt', 'w') as f:
-    f.write(content)
+# Text from a file is spoken as it is, without the server's cleaning stages
+payload = {'text': content, 'stages': []}
+if args.parallel:
+    payload['parallel'] = True
+
+
+def send_via_socket(payload, socket_path=SOCKET_PATH):
+    """Sends the request over the server's local socket. Returns False if the server isn't listening."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(socket_path)
+            sock.sendall((json.dumps(payload) + '\n').encode('utf-8'))
+            reply = sock.makefile('r', encoding='utf-8').readline()
+    except OSError:
+        return False
+    print(f"Server response: {reply.strip()}")
+    return True
+
+
+def socket_is_listening(socket_path):
+    """True if a server accepts connections on the socket; a stale file left by a crash doesn't."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            sock.connect(socket_path)
+    except OSError:
+        return False
+    return True
+
 
-service_name = "speak_server.py"
-check_command = ['pgrep', '-f', service_name]
+def read_endpoint():
+    """Returns the endpoint the running server announced, or None if there is no live server."""
+    try:
+        with open(ENDPOINT_FILE, 'r') as f:
+            endpoint = json.load(f)
+        os.kill(endpoint['pid'], 0)
+        return endpoint
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
 
-# Check if server is running
-result = subprocess.run(check_command, capture_output=True)
-url_to_use = HTTPS_URL # Standardmäßig HTTPS versuchen
 
-if result.returncode != 0:
-    print(f"'{service_name}' not running. Starting it now...")
+def start_server_and_wait(session):
+    """Starts the server and waits until it announces itself and its port answers."""
+    print("Server not running. Starting it now...")
     subprocess.Popen([START_SERVER_SCRIPT], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     print("Waiting for server to become ready...")
-    server_ready = False
-    max_wait_time = 10
-    start_time = time.time()
-
-    while time.time() - start_time < max_wait_time:
-        try:
-            # Zuerst HTTPS versuchen
-            requests.head(HTTPS_URL, verify=False, timeout=1)
-            print("Server is ready on HTTPS!")
-            url_to_use = HTTPS_URL
-            server_ready = True
-            break
-        except requests.exceptions.SSLError:
-            # Wenn SSL fehlschlägt, ist der Server wahrscheinlich im HTTP-Modus
-            print("SSL failed, trying HTTP...")
+    deadline = time.time() + MAX_WAIT_TIME
+    while time.time() < deadline:
+        endpoint = read_endpoint()
+        if endpoint is not None:
             try:
-                requests.head(HTTP_URL, timeout=1)
-                print("Server is ready on HTTP!")
-                url_to_use = HTTP_URL
-                server_ready = True
+                # 503 just means the models are still loading; the job waits for them
+                session.get(f"{endpoint['url']}/ready", verify=False, timeout=1)
+                print(f"Server is up on {endpoint['url']}!")
+                return endpoint
+            except requests.exceptions.RequestException:
+                pass
+        time.sleep(0.1)
+
+    log_path = os.path.join(PROJECT_ROOT, 'server.log')
+    print(f"Server did not start within {MAX_WAIT_TIME} seconds.")
+    print(f"Please check the log file for errors: '{log_path}'")
+    sys.exit(1)
+
+
+def iter_paragraph_chunks(path, offset=0):
+    """
+    Reads the file from byte `offset` and yields (text, end_offset) for
+    groups of whole paragraphs. Only one group is held in memory at a time.
+    `end_offset` is the byte position right after the group, where a later
+    run can resume.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    lines = []
+    size = 0
+    position = offset
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            raw = f.readline(INCREMENTAL_MAX_CHUNK_CHARS)
+            if not raw:
                 break
-            except requests.exceptions.ConnectionError:
-                time.sleep(0.5) # Server vielleicht noch nicht ganz oben
-        except requests.exceptions.ConnectionError:
-            time.sleep(0.5)
-
-    if not server_ready:
-        log_path = os.path.join(PROJECT_ROOT, 'server.log')
-        print(f"Server did not start within {max_wait_time} seconds.")
-        print(f"Please check the log file for errors: '{log_path}'")
+            position += len(raw)
+            line = decoder.decode(raw)
+            paragraph_end = not line.strip()
+            lines.append(line)
+            size += len(line)
+            if (paragraph_end and size >= INCREMENTAL_CHUNK_CHARS) or size >= INCREMENTAL_MAX_CHUNK_CHARS:
+                text = ''.join(lines).strip()
+                if text:
+                    yield text, position
+                lines, size = [], 0
+    text = (''.join(lines) + decoder.decode(b'', final=True)).strip()
+    if text:
+        yield text, position
+
+
+def load_progress():
+    try:
+        with open(PROGRESS_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_progress(path, offset):
+    """Remembers how far `path` was spoken; a finished file is forgotten."""
+    progress = load_progress()
+    key = os.path.abspath(path)
+    if offset is None or offset >= os.path.getsize(path):
+        progress.pop(key, None)
+    else:
+        progress[key] = offset
+    os.makedirs(os.path.dirname(PROGRESS_FILE), exist_ok=True)
+    with open(PROGRESS_FILE, 'w') as f:
+        json.dump(progress, f, indent=2)
+
+
+def queue_followed_via_socket(payload, socket_path):
+    """
+    Queues a job over the socket and keeps the connection open, so the
+    server reports when it is finished. Returns (job_id, reader).
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    sock.sendall((json.dumps({**payload, 'follow': True}) + '\n').encode('utf-8'))
+    reader = sock.makefile('r', encoding='utf-8')
+    sock.close()  # the reader keeps the connection open
+    reply = json.loads(reader.readline() or '{}')
+    if reply.get('status') != 'queued':
+        reader.close()
+        raise RuntimeError(f"Server did not accept the request: {reply}")
+    return reply['job_id'], reader
+
+
+def wait_followed(reader):
+    """Reads the progress lines of a followed job until its final state."""
+    with reader:
+        for line in reader:
+            message = json.loads(line)
+            if message.get('status') != 'progress':
+                return message.get('state')
+    return 'error'
+
+
+def wait_for_first(pending, wait_chunk, path, spoken_offset):
+    """Waits until the oldest pending chunk was spoken and returns the new progress offset."""
+    handle, end_offset = pending[0]
+    state = wait_chunk(handle)
+    if state != 'done':
+        raise RuntimeError(f"Chunk ended with state '{state}'")
+    pending.pop(0)
+    save_progress(path, end_offset)
+    print(f"Spoken up to byte {end_offset} of {os.path.getsize(path)}.")
+    return end_offset
+
+
+def cancel_jobs(job_ids):
+    """Best effort: cancels jobs over HTTP, if the server announced a URL."""
+    endpoint = read_endpoint()
+    if not job_ids or endpoint is None:
+        return
+    import requests
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    for job_id in job_ids:
+        try:
+            requests.delete(f"{endpoint['url']}/jobs/{job_id}", verify=False, timeout=2)
+        except requests.exceptions.RequestException:
+            pass
+
+
+def speak_incrementally(path, offset, socket_path=None, session=None, url=None):
+    """
+    Sends the file chunk by chunk, at most INCREMENTAL_AHEAD chunks ahead of
+    the one being spoken, so neither side ever holds the whole file.
+    Progress is saved after every spoken chunk.
+    """
+    if socket_path:
+        def queue_chunk(chunk_payload):
+            return queue_followed_via_socket(chunk_payload, socket_path)
+
+        def wait_chunk(handle):
+            return wait_followed(handle[1])
+    else:
+        def queue_chunk(chunk_payload):
+            reply = session.post(f"{url}/speak", json=chunk_payload, verify=False).json()
+            if reply.get('status') != 'queued':
+                raise RuntimeError(f"Server did not accept the request: {reply}")
+            return reply['job_id'], None
+
+        def wait_chunk(handle):
+            while True:
+                state = session.get(f"{url}/jobs/{handle[0]}", verify=False).json().get('state')
+                if state in FINAL_STATES:
+                    return state
+                time.sleep(0.2)
+
+    pending = []
+    spoken_offset = offset
+    try:
+        for text, end_offset in iter_paragraph_chunks(path, offset):
+            # Each chunk is streamed, so it starts playing after its first sentence;
+            # a paragraph that repeats in the file must be read again, not deduplicated
+            pending.append((queue_chunk({**payload, 'text': text, 'stream': True, 'dedup': False}), end_offset))
+            if len(pending) > INCREMENTAL_AHEAD:
+                spoken_offset = wait_for_first(pending, wait_chunk, path, spoken_offset)
+        while pending:
+            spoken_offset = wait_for_first(pending, wait_chunk, path, spoken_offset)
+        save_progress(path, None)
+        print("File finished.")
+    except (KeyboardInterrupt, RuntimeError, OSError) as e:
+        # Chunks that were sent but not spoken yet must not play after we stopped
+        cancel_jobs([handle[0] for handle, _ in pending])
+        save_progress(path, spoken_offset)
+        print(f"\nStopped ({str(e) or 'interrupted'}). Continue with: speak_file.py --resume {path}  (or --offset {spoken_offset})")
         sys.exit(1)
 
-# Jetzt wissen wir, welche URL wir benutzen müssen (url_to_use)
+
+if incremental:
+    start_offset = args.offset
+    if start_offset is None:
+        start_offset = load_progress().get(os.path.abspath(args.file), 0) if args.resume else 0
+    print(f"Reading '{args.file}' incrementally from byte {start_offset}...")
+    if socket_is_listening(SOCKET_PATH):
+        speak_incrementally(args.file, start_offset, socket_path=SOCKET_PATH)
+        sys.exit(0)
+
+# Fast path: a running server takes the text straight from its socket, no HTTP at all
+if not incremental and send_via_socket(payload):
+    sys.exit(0)
+
+# requests is only needed (and only imported) when the socket isn't available
+import requests
+import urllib3
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# One keep-alive session for the readiness check and the request itself
+session = requests.Session()
+endpoint = read_endpoint() or start_server_and_wait(session)
+
+if incremental:
+    if endpoint.get('socket') and socket_is_listening(endpoint['socket']):
+        speak_incrementally(args.file, start_offset, socket_path=endpoint['socket'])
+    else:
+        speak_incrementally(args.file, start_offset, session=session, url=endpoint['url'])
+    sys.exit(0)
+
+if endpoint.get('socket') and send_via_socket(payload, endpoint['socket']):
+    sys.exit(0)
+
+url_to_use = f"{endpoint['url']}/speak"
 print(f"Sending request to server at {url_to_use}...")
 try:
-    # Verwende die URL, die im Health-Check funktioniert hat
-    response = requests.post(url_to_use, verify=False)
+    response = session.post(url_to_use, json=payload, verify=False)
     print(f"Server response: {response.status_code}")
 except Exception as e:
     print(f"Failed to connect to the server: {e}")
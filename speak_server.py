@@ -1,38 +1,62 @@
 #!/usr/bin/env python3
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
-from slugify import slugify
 import shlex
+import shutil
 import subprocess
 import wave
 import datetime
 import argparse
 import re
+import functools
+import itertools
 import os
-import random
+import json
+import atexit
+import tempfile
+import threading
+import hashlib
+import socketserver
+import sqlite3
+import struct
+import uuid
+import contextlib
+import signal
+import fcntl
+import time
+import sys
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import queue
+from collections import deque, OrderedDict
 from pathlib import Path
+import warnings
 
-# https://dl.fbaipublicfiles.com/fasttext/supervised-models/lid.176.bin
-# pip install fasttext
-import fasttext
+# audioop ist bis Python 3.12 Teil der Standardbibliothek und resampelt in C
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    try:
+        import audioop
+    except ImportError:
+        audioop = None
 
 SCRIPT_DIR = Path(__file__).resolve().parent
 
 
-MODEL_PATH = f"{SCRIPT_DIR}/model/lid.176.bin"
-model = fasttext.load_model(MODEL_PATH)
+# https://dl.fbaipublicfiles.com/fasttext/supervised-models/lid.176.bin (126 MB)
+# https://dl.fbaipublicfiles.com/fasttext/supervised-models/lid.176.ftz (917 kB, quantisiert)
+# pip install fasttext
+# Das Modell wird erst im Hintergrund bzw. bei der ersten Anfrage geladen.
+# Reihenfolge: --lang-model, $SPEAK_LANG_MODEL, sonst das erste vorhandene aus LANG_MODEL_CANDIDATES.
+LANG_MODEL_CANDIDATES = [f"{SCRIPT_DIR}/model/lid.176.bin", f"{SCRIPT_DIR}/model/lid.176.ftz"]
+MODEL_PATH = os.environ.get('SPEAK_LANG_MODEL') or next(
+    (path for path in LANG_MODEL_CANDIDATES if os.path.exists(path)), LANG_MODEL_CANDIDATES[0])
 
 MODELS = { 'de': f"{SCRIPT_DIR}/model/de/de_DE-kerstin-low.onnx" , 'en': f"{SCRIPT_DIR}/model/en/en_GB-jenny_dioco-medium.onnx" }
 
 
-from markdown_it import MarkdownIt
-from pygments import highlight
-
-
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import TerminalFormatter # Not for output, but for tokenizing
-from pygments.token import Comment, String
-from bs4 import BeautifulSoup
+# markdown_it, pygments, bs4 und slugify werden erst beim ersten Gebrauch importiert,
+# damit der Server seinen Port sofort öffnen kann.
 
 # --- install
 # read
@@ -58,8 +82,146 @@ SAMPLE_RATE = 22050
 SAMPLE_WIDTH = 2  # 2 bytes = 16-bit
 CHANNELS = 1      # Mono
 MY_STOPWORDS = ['das', 'ist', 'ein', 'mit', 'und', 'a', 'is', 'with', 'the']
+
+# Streaming: Sätze kürzer als das werden mit dem nächsten Satz zusammengelegt,
+# damit Piper nicht für jedes "Ja." eine eigene Pause einbaut.
+STREAM_MIN_SENTENCE_CHARS = 40
+# Wie viele fertig synthetisierte Sätze höchstens auf die Wiedergabe warten
+STREAM_PREFETCH = 2
+# Audioausgabe: 'auto' (PulseAudio/PipeWire, dann ALSA, dann aplay), 'pulse', 'alsa', 'aplay',
+# 'null' oder 'file:PFAD'. Das Gerät bleibt offen; gespielt wird in Perioden von AUDIO_PERIOD_MS,
+# höchstens AUDIO_QUEUE_MS liegen in der Warteschlange (so schnell greift auch ein Abbruch).
+AUDIO_SINK = 'auto'
+AUDIO_PERIOD_MS = 50
+AUDIO_QUEUE_MS = 500
+ALSA_DEVICE = 'default'
+APLAY_BUFFER_US = 100_000
+# Live-Mithören (GET /jobs/<id>/audio): so viele Audio-Abschnitte eines Auftrags werden
+# vorgehalten; wer weiter zurückliegt, springt nach vorn
+AUDIO_RING_CHUNKS = 16
+
+# Synthese-Cache: Obergrenze im Speicher (MB), optional zusätzlich auf Platte
+CACHE_MAX_MB = 64
+CACHE_DISK_MAX_MB = 512
+
+# Paralleler Modus: Zielgröße eines Abschnitts und Anzahl der Piper-Worker
+PARALLEL_CHUNK_CHARS = 400
+PARALLEL_WORKERS = os.cpu_count() or 1
+# Höchstens so viele Piper-Instanzen pro Stimme gleichzeitig (Aufträge, /synthesize, paralleler Modus)
+VOICE_CONCURRENCY = PARALLEL_WORKERS
+# Ein-/Ausblenden an Abschnittsgrenzen gegen Knackser (Millisekunden)
+CHUNK_FADE_MS = 5
+
+# Was mit einer neuen Anfrage passiert, während noch gesprochen wird:
+# 'queue' = hinten anstellen, 'preempt' = aktuelle Wiedergabe sofort abbrechen,
+# 'drop' = neue Anfrage verwerfen
+BARGE_IN_MODES = ('queue', 'preempt', 'drop')
+
+# Histogramm-Grenzen für /metrics: Dauern in Sekunden, Echtzeitfaktor
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RTF_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100)
+
+# Wie viele abgeschlossene Aufträge für /jobs/<id> aufgehoben werden
+JOB_HISTORY = 200
+# Beim Beenden (SIGTERM/Strg+C) höchstens so lange auf laufende und wartende Aufträge warten (Sekunden)
+SHUTDOWN_DRAIN_TIMEOUT = 120
+# Gleicher Text (bis auf Leerraum) innerhalb so vieler Sekunden nach dem Ende des ersten
+# Auftrags wird nicht erneut gesprochen, sondern an diesen Auftrag angehängt (0 = aus)
+DEDUP_WINDOW_SECONDS = 10
+# Sitzungen (/sessions): kommt so viele Sekunden kein Text mehr, wird der Rest gesprochen
+# und die Sitzung geschlossen, damit sie die Warteschlange nicht ewig blockiert
+SESSION_IDLE_TIMEOUT = 30
+# Die Sprache einer Sitzung wird erst bestimmt, wenn so viele Zeichen fertig sind
+# (oder die Sitzung endet); ein "Klar!" allein reicht fastText nicht
+SESSION_DETECT_MIN_CHARS = STREAM_MIN_SENTENCE_CHARS
+
+# --production: Threads des cheroot-WSGI-Servers
+SERVER_THREADS = 16
+
+# Spracherkennung: nur so viele Zeichen an fastText geben, Mindestsicherheit,
+# Mindestlänge und Sprache, wenn die Erkennung unsicher ist
+LANG_DETECT_MAX_CHARS = 1000
+LANG_MIN_CONFIDENCE = 0.5
+LANG_MIN_CHARS = 3
+LANG_CACHE_SIZE = 4096
+DEFAULT_LANG = 'de'
+
+# Archiv: Encoder für die komprimierten Formate, lesen rohes 16-bit Mono-PCM von stdin
+ARCHIVE_ENCODERS = {
+    'flac': ["flac", "--silent", "--force", "--force-raw-format", "--endian=little", "--sign=signed",
+             "--channels=1", "--bps=16", "--sample-rate={rate}", "-o", "{path}", "-"],
+    'opus': ["opusenc", "--quiet", "--raw", "--raw-bits", "16", "--raw-rate", "{rate}", "--raw-chan", "1",
+             "--raw-endianness", "0", "--bitrate", "24", "-", "{path}"],
+}
+ARCHIVE_FORMAT = 'flac'
+# SQLite-Index des Archivs, liegt im Archivverzeichnis
+ARCHIVE_INDEX_NAME = 'archive.sqlite3'
+
+# Lokaler Unix-Socket für speak_file.py, AutoKey & Co. (leer = abgeschaltet)
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'speak_server.sock')
+# Hier schreibt der Server beim Start URL, Socket und PID hinein, damit Clients
+# ihn ohne pgrep und Herumprobieren von HTTPS/HTTP finden
+ENDPOINT_FILE = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'speak_server.json')
+# Wie oft ein Client mit "follow" Statusmeldungen bekommt (Sekunden)
+SOCKET_FOLLOW_INTERVAL = 0.2
+
+# Mit --warmup spricht jede Stimme nach dem Laden einmal diesen Text (ohne Wiedergabe),
+# damit auch onnxruntime seine erste, langsame Inferenz schon hinter sich hat
+WARMUP_TEXTS = {'de': "Hallo.", 'en': "Hello."}
+
+# Piper-Kommando für den Fallback ohne Python-Binding (pip install piper-tts)
+PIPER_CMD = "piper-tts"
 # --------------------
 
+# --- Vorkompilierte Regeln für die Textreinigung ---
+# Alle Muster werden einmal beim Import kompiliert. Jede Stufe überspringt
+# Durchläufe, die auf dem aktuellen Text gar nicht treffen können (z.B. gibt es
+# ohne '```' keinen Codeblock), so bleibt das Ergebnis exakt gleich.
+CODE_BLOCK_RE = re.compile(r'```.*?```', flags=re.DOTALL)
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+URL_RE = re.compile(r'https?://\S+')
+FILE_PATH_RE = re.compile(r'\b(?:[a-zA-Z]:)?/[^:\s\n\r]+')
+CAMEL_CASE_RE = re.compile(r'([a-z0-9])([A-Z])')
+# Programmiersymbole werden per str.translate in einem Durchlauf zu Leerzeichen
+SYMBOLS_TO_SPACE = str.maketrans({char: ' ' for char in '{}()[]#*<>;|\\/'})
+
+COPY_GUARD_RE = re.compile(r'IGNORE_WHEN_COPYING_START.*?IGNORE_WHEN_COPYING_END', flags=re.DOTALL)
+COPY_GUARD_WORDS = ('content_copy', 'download', 'Use code with caution')
+COPY_WORDS_RE = re.compile(r'\b(content_copy|download|Use code with caution.)\b')
+PERMISSION_LINE_RE = re.compile(r'(?m)^[d-][rwx-]{9}.*?$\n?')
+GENERATED_COMMAND_RE = re.compile(r'Generated (bash|code)\n(.*?)\n\n', flags=re.DOTALL)
+NEWLINES_RE = re.compile(r'\n+')
+SPACES_RE = re.compile(r' +')
+
+SHELL_LANGS = ('bash', 'sh', 'shell', 'zsh')
+PYTHON_KEYWORDS = (
+    'def ', 'class ', 'import ', 'from ', 'try:', 'except:', 'finally:',
+    'with ', 'if ', 'elif ', 'else:', 'for ', 'while ', 'return '
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _markdown():
+    """One parser for all requests, instead of building a new one for every call."""
+    from markdown_it import MarkdownIt
+    return MarkdownIt()
+
+
+def _normalize_whitespace(text: str) -> str:
+    """Same as re.sub(r'\\s+', ' ', text).strip(), but in one C-level pass."""
+    return ' '.join(text.split())
+
+
+@functools.lru_cache(maxsize=64)
+def _get_lexer(lang: str):
+    """Returns the Pygments lexer for `lang`, or None if it is unknown."""
+    from pygments.lexers import get_lexer_by_name
+    try:
+        return get_lexer_by_name(lang)
+    except Exception:
+        return None
+
+
 # --- Our custom command translator from before ---
 def _translate_shell_command(command: str) -> str | None:
     command = command.strip()
@@ -90,31 +252,25 @@ def clean_text_for_tts(text: str) -> str:
         return ""
 
     # 1. Remove multi-line code blocks (like ```python...```)
-    # The re.DOTALL flag makes '.' match newlines as well.
-    text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
+    if '```' in text:
+        text = CODE_BLOCK_RE.sub('', text)
 
     # 2. Remove inline code snippets (like `my_variable`)
     # We will process the content of these later, but for now, just remove the backticks.
-    text = re.sub(r'`', '', text)
+    text = text.replace('`', '')
 
     # 3. Remove HTML/XML tags
-    text = re.sub(r'<[^>]+>', '', text)
+    if '<' in text:
+        text = HTML_TAG_RE.sub('', text)
 
     # 4. Replace URLs with a more speakable alternative
-    text = re.sub(r'https?://\S+', ' a web address ', text)
+    if '://' in text:
+        text = URL_RE.sub(' a web address ', text)
 
     # 5. Replace file paths (e.g., /home/user/file.txt)
     # This is a simple heuristic looking for paths with multiple slashes.
-    text = re.sub(r'\b(?:[a-zA-Z]:)?/[^:\s\n\r]+', ' a file path ', text)
-
-    # 5.1 Remove empty lines
-    # This is a simple heuristic looking for paths with multiple slashes.
-    # text = re.sub(r'[\r\n]$', ' ', text)
-    # text = re.sub(r'^$(\r\n|\r|\n)?', ' ', text)
-    # text = re.sub(r'^\s*?$(\r\n|\r|\n)?', ' ', text)
-    # text = re.sub(r'^[ \t]*?$(\r\n|\r|\n)?', '', text)
-    # text = re.sub(r'^ *?$(\r\n|\r|\n)?', ' ', text)
-    # text = re.sub(r'^\t*?$(\r\n|\r|\n)?', ' ', text)
+    if '/' in text:
+        text = FILE_PATH_RE.sub(' a file path ', text)
 
     # remove empty lines:
     # https://yanohirota.com/en/regex-blank-line/
@@ -122,88 +278,39 @@ def clean_text_for_tts(text: str) -> str:
     # https://regex101.com/r/hL2gQ2/1
     # https://stackoverflow.com/questions/24796205/using-regex-to-delete-extra-empty-lines-of-a-text
 
-
-
     # 6. "Humanize" variable names
     # a. Convert camelCase to "camel case"
-    text = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', text)
+    text = CAMEL_CASE_RE.sub(r'\1 \2', text)
     # b. Convert snake_case to "snake case"
     text = text.replace('_', ' ')
 
     # 7. Remove common programming symbols and other non-speakable characters
     # This keeps basic punctuation but removes things like #, {}, [], <, >, etc.
-    text = re.sub(r'[{}()\[\]#*<>;|\\/]', ' ', text)
+    text = text.translate(SYMBOLS_TO_SPACE)
 
     # 8. Normalize whitespace
     # Replace multiple spaces/newlines with a single space
-    text = re.sub(r'\s+', ' ', text).strip()
-
-    return text
-
-
-def clean_interactive_text_for_tts(text: str) -> str:
-    """
-    Cleans text from an interactive session (like a tutorial) for a TTS engine.
-
-    This is more advanced than the basic cleaner. It tries to interpret
-    the intent behind the code and translate it into a spoken narrative.
-    """
-    if not isinstance(text, str):
-        return ""
-
-    # 1. Remove specific guard text and metadata
-    # This targets the blocks like IGNORE_WHEN_COPYING_START...END
-    text = re.sub(
-        r'IGNORE_WHEN_COPYING_START.*?IGNORE_WHEN_COPYING_END',
-        '',
-        text,
-        flags=re.DOTALL
-    )
-    # This targets the lines with 'content_copy', 'download', etc.
-    text = re.sub(r'\b(content_copy|download|Use code with caution.)\b', '', text)
-
-
-    # 2. Remove multi-line, un-speakable code output.
-    # This regex looks for lines that start with file permissions (e.g., -rw-r--r-- or drwxr-xr-x)
-    # It will remove the entire block of such lines.
-    text = re.sub(r'(?m)^[d-][rwx-]{9}.*?$\n?', '', text)
-
-
-    # 3. Translate common, simple shell commands into spoken instructions.
-    # We use a function for replacement to handle the command's arguments.
-    def translate_command(match):
-        command = match.group(1).strip()
-        # Simple cd command
-        if command.startswith('cd '):
-            path = command.split(' ', 1)[1]
-            # Make the path a little more speakable
-            path = path.replace('~', 'your home directory')
-            return f'First, change directory to {path}.'
-        # Simple ls command
-        if command.startswith('ls'):
-            return 'Now, list the files in the directory.'
-        # Simple unzip command
-        if command.startswith('unzip '):
-            filename = command.split(' ', 1)[1]
-            return f'Next, unzip the file named {filename}.'
-        # Fallback for other commands
-        return f'Run the command: {command}.'
-
-    # The regex finds lines that start with 'Generated bash' or 'Generated code'
-    # and then captures the command on the next line(s).
-    text = re.sub(r'Generated (bash|code)\n(.*?)\n\n', translate_command, text, flags=re.DOTALL)
-
-
-    # 4. Final whitespace normalization
-    text = re.sub(r'\n+', '\n', text) # Consolidate multiple newlines
-    text = re.sub(r' +', ' ', text).strip() # Consolidate spaces
-    text = text.replace('\n', ' ') # Replace newlines with spaces for a single block of text
-
-    return text
-
-
-
-
+    return _normalize_whitespace(text)
+
+
+def _translate_generated_command(match):
+    """Turns a 'Generated bash/code' block into a spoken instruction."""
+    command = match.group(1).strip()
+    # Simple cd command
+    if command.startswith('cd '):
+        path = command.split(' ', 1)[1]
+        # Make the path a little more speakable
+        path = path.replace('~', 'your home directory')
+        return f'First, change directory to {path}.'
+    # Simple ls command
+    if command.startswith('ls'):
+        return 'Now, list the files in the directory.'
+    # Simple unzip command
+    if command.startswith('unzip '):
+        filename = command.split(' ', 1)[1]
+        return f'Next, unzip the file named {filename}.'
+    # Fallback for other commands
+    return f'Run the command: {command}.'
 
 
 def clean_interactive_text_for_tts(text: str) -> str:
@@ -218,53 +325,30 @@ def clean_interactive_text_for_tts(text: str) -> str:
 
     # 1. Remove specific guard text and metadata
     # This targets the blocks like IGNORE_WHEN_COPYING_START...END
-    text = re.sub(
-        r'IGNORE_WHEN_COPYING_START.*?IGNORE_WHEN_COPYING_END',
-        '',
-        text,
-        flags=re.DOTALL
-    )
+    if 'IGNORE_WHEN_COPYING_START' in text:
+        text = COPY_GUARD_RE.sub('', text)
     # This targets the lines with 'content_copy', 'download', etc.
-    text = re.sub(r'\b(content_copy|download|Use code with caution.)\b', '', text)
-
+    if any(word in text for word in COPY_GUARD_WORDS):
+        text = COPY_WORDS_RE.sub('', text)
 
     # 2. Remove multi-line, un-speakable code output.
     # This regex looks for lines that start with file permissions (e.g., -rw-r--r-- or drwxr-xr-x)
     # It will remove the entire block of such lines.
-    text = re.sub(r'(?m)^[d-][rwx-]{9}.*?$\n?', '', text)
-
+    text = PERMISSION_LINE_RE.sub('', text)
 
     # 3. Translate common, simple shell commands into spoken instructions.
-    # We use a function for replacement to handle the command's arguments.
-    def translate_command(match):
-        command = match.group(1).strip()
-        # Simple cd command
-        if command.startswith('cd '):
-            path = command.split(' ', 1)[1]
-            # Make the path a little more speakable
-            path = path.replace('~', 'your home directory')
-            return f'First, change directory to {path}.'
-        # Simple ls command
-        if command.startswith('ls'):
-            return 'Now, list the files in the directory.'
-        # Simple unzip command
-        if command.startswith('unzip '):
-            filename = command.split(' ', 1)[1]
-            return f'Next, unzip the file named {filename}.'
-        # Fallback for other commands
-        return f'Run the command: {command}.'
-
     # The regex finds lines that start with 'Generated bash' or 'Generated code'
     # and then captures the command on the next line(s).
-    text = re.sub(r'Generated (bash|code)\n(.*?)\n\n', translate_command, text, flags=re.DOTALL)
-
+    if 'Generated ' in text:
+        text = GENERATED_COMMAND_RE.sub(_translate_generated_command, text)
 
     # 4. Final whitespace normalization
-    text = re.sub(r'\n+', '\n', text) # Consolidate multiple newlines
-    text = re.sub(r' +', ' ', text).strip() # Consolidate spaces
-    text = text.replace('\n', ' ') # Replace newlines with spaces for a single block of text
-
-    return text
+    if '\n' in text:
+        text = NEWLINES_RE.sub('\n', text) # Consolidate multiple newlines
+    if '  ' in text:
+        text = SPACES_RE.sub(' ', text) # Consolidate spaces
+    text = text.strip()
+    return text.replace('\n', ' ') # Replace newlines with spaces for a single block of text
 
 def clean_python_code_for_tts(text: str) -> str:
     """
@@ -282,15 +366,8 @@ def clean_python_code_for_tts(text: str) -> str:
         return ""
 
     cleaned_lines = []
-    # These are strong indicators that a line is code, not narration.
-    python_keywords = (
-        'def ', 'class ', 'import ', 'from ', 'try:', 'except:', 'finally:',
-        'with ', 'if ', 'elif ', 'else:', 'for ', 'while ', 'return '
-    )
 
-    lines = text.split('\n')
-
-    for line in lines:
+    for line in text.split('\n'):
         stripped_line = line.strip()
 
         # Rule 1: If the line is empty, skip it.
@@ -308,7 +385,7 @@ def clean_python_code_for_tts(text: str) -> str:
 
         # Rule 3: Check for strong indicators of code to DISCARD the line.
         # a) Starts with a common Python keyword.
-        if stripped_line.startswith(python_keywords):
+        if stripped_line.startswith(PYTHON_KEYWORDS):
             continue
         # b) Starts with significant indentation (a key feature of Python code blocks).
         if line.startswith(('    ', '\t')):
@@ -329,8 +406,7 @@ def clean_python_code_for_tts(text: str) -> str:
 
 
     # Final Step: Join the kept lines and normalize whitespace.
-    full_text = ' '.join(cleaned_lines)
-    return re.sub(r'\s+', ' ', full_text).strip()
+    return _normalize_whitespace(' '.join(cleaned_lines))
 
 def clean_text_with_libraries(text: str) -> str:
     """
@@ -339,8 +415,9 @@ def clean_text_with_libraries(text: str) -> str:
     - Uses pygments to intelligently extract comments from code.
     - Uses BeautifulSoup to clean any remaining HTML.
     """
-    md = MarkdownIt()
-    tokens = md.parse(text)
+    from pygments.token import Comment
+
+    tokens = _markdown().parse(text)
 
     speakable_parts = []
 
@@ -351,37 +428,217 @@ def clean_text_with_libraries(text: str) -> str:
             code_content = token.content
 
             # Sub-case: It's shell/bash commands we want to translate
-            if lang in ['bash', 'sh', 'shell', 'zsh']:
+            if lang in SHELL_LANGS:
                 for line in code_content.split('\n'):
                     if line.strip():
                         translated = _translate_shell_command(line)
                         speakable_parts.append(translated)
             # Sub-case: It's Python or another language where we want comments
             elif lang:
-                try:
-                    lexer = get_lexer_by_name(lang)
-                    code_tokens = lexer.get_tokens(code_content)
-                    for ttype, tvalue in code_tokens:
-                        # We keep comments and sometimes strings if they are user-facing
-                        if ttype in Comment:
-                            # Clean the comment syntax and add the text
-                            speakable_parts.append(tvalue.strip('# \n'))
-                except Exception:
-                    # If language is unknown, just ignore the block
-                    pass
-
-        # Case 2: It's a paragraph or other inline text
-        elif token.type == 'paragraph_open':
-            # The actual content is in the next 'inline' token
-            pass
+                lexer = _get_lexer(lang)
+                # If language is unknown, just ignore the block
+                if lexer is not None:
+                    try:
+                        for ttype, tvalue in lexer.get_tokens(code_content):
+                            # We keep comments and sometimes strings if they are user-facing
+                            if ttype in Comment:
+                                # Clean the comment syntax and add the text
+                                speakable_parts.append(tvalue.strip('# \n'))
+                    except Exception:
+                        pass
+
+        # Case 2: It's inline text (the content of a paragraph, heading, ...)
         elif token.type == 'inline':
-            # Use BeautifulSoup to strip any potential HTML tags (like <b>)
-            soup = BeautifulSoup(token.content, 'html.parser')
-            speakable_parts.append(soup.get_text())
+            content = token.content
+            # Use BeautifulSoup to strip any potential HTML tags (like <b>) or
+            # entities (like &amp;). Plain text comes out unchanged anyway.
+            if '<' in content or '&' in content:
+                from bs4 import BeautifulSoup
+                content = BeautifulSoup(content, 'html.parser').get_text()
+            speakable_parts.append(content)
 
     # Join all the collected parts and normalize whitespace
-    final_text = ' '.join(filter(None, speakable_parts))
-    return ' '.join(final_text.split())
+    return _normalize_whitespace(' '.join(filter(None, speakable_parts)))
+
+
+# --- Registrierte Reinigungsstufen ---
+# Die Stufen laufen in dieser Reihenfolge. Ein Client kann pro Anfrage mit
+# "stages" (nur diese) oder "skip_stages" (alle außer diesen) auswählen, z.B.
+# {"text": "...", "skip_stages": ["libraries"]} für bereits reinen Text.
+CLEANING_STAGES = OrderedDict([
+    ('basic', clean_text_for_tts),
+    ('interactive', clean_interactive_text_for_tts),
+    ('libraries', clean_text_with_libraries),
+    ('python', clean_python_code_for_tts),
+])
+
+
+def register_cleaning_stage(name: str, func, before: str | None = None):
+    """
+    Adds a cleaning stage `func(text) -> text` to the pipeline, at the end
+    or in front of the stage `before`.
+    """
+    if before is None:
+        CLEANING_STAGES[name] = func
+        return
+    stages = list(CLEANING_STAGES.items())
+    index = [stage_name for stage_name, _ in stages].index(before)
+    stages.insert(index, (name, func))
+    CLEANING_STAGES.clear()
+    CLEANING_STAGES.update(stages)
+
+
+# --- Metriken (Prometheus) ---
+class Metrics:
+    """
+    A small Prometheus registry: labelled counters, histograms and gauges,
+    rendered in the text exposition format for GET /metrics.
+    """
+
+    def __init__(self):
+        self._help = {}
+        self._types = {}
+        self._buckets = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str):
+        self._help[name], self._types[name] = help_text, 'counter'
+        self._counters[name] = {}
+
+    def histogram(self, name: str, help_text: str, buckets=METRICS_BUCKETS):
+        self._help[name], self._types[name] = help_text, 'histogram'
+        self._buckets[name] = tuple(buckets)
+        self._histograms[name] = {}
+
+    def gauge(self, name: str, help_text: str, read):
+        """`read()` is called at every scrape and returns the current value."""
+        self._help[name], self._types[name] = help_text, 'gauge'
+        self._gauges[name] = read
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._counters[name]
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms[name].setdefault(
+                key, {"buckets": [0] * len(self._buckets[name]), "sum": 0.0, "count": 0})
+            for index, bound in enumerate(self._buckets[name]):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(key, extra=()) -> str:
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{label}="{escape(value)}"' for label, value in pairs) + '}'
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name in self._types:
+                lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {self._types[name]}")
+                if name in self._counters:
+                    for key, value in self._counters[name].items():
+                        lines.append(f"{name}{self._labels(key)} {value}")
+                elif name in self._histograms:
+                    for key, series in self._histograms[name].items():
+                        for bound, count in zip(self._buckets[name], series["buckets"]):
+                            lines.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {count}")
+                        lines.append(f"{name}_bucket{self._labels(key, [('le', '+Inf')])} {series['count']}")
+                        lines.append(f"{name}_sum{self._labels(key)} {series['sum']}")
+                        lines.append(f"{name}_count{self._labels(key)} {series['count']}")
+                else:
+                    lines.append(f"{name} {self._gauges[name]()}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.histogram('speak_cleaning_seconds', "Dauer einer Reinigungsstufe.")
+metrics.histogram('speak_language_detection_seconds', "Dauer der Spracherkennung (ein Aufruf, ggf. gebündelt).")
+metrics.histogram('speak_synthesis_seconds', "Dauer eines Piper-Aufrufs.")
+metrics.histogram('speak_time_to_first_audio_seconds', "Zeit vom Start eines Auftrags bis zum ersten Audio an die Ausgabe.")
+metrics.histogram('speak_playback_seconds', "Dauer der Wiedergabe vom ersten Audio bis zum Ende der Ausgabe.")
+metrics.histogram('speak_archive_write_seconds', "Dauer des Speicherns im Archiv (Kodieren, Schreiben, Index).")
+metrics.histogram('speak_real_time_factor', "Audiosekunden pro Sekunde Synthese.", RTF_BUCKETS)
+metrics.counter('speak_requests_total', "Gesprochene Aufträge nach Sprache und Stimme.")
+metrics.counter('speak_synthesized_audio_seconds_total', "Von Piper erzeugte Audiosekunden.")
+metrics.counter('speak_piper_errors_total', "Fehlgeschlagene Piper-Aufrufe.")
+metrics.counter('speak_deduplicated_total', "Anfragen, die an einen gleichen Auftrag angehängt wurden.")
+
+
+class StageTimings:
+    """Collects how often each cleaning stage ran and how long it took."""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            stats = self._stats.setdefault(name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["calls"] += 1
+            stats["total_ms"] += seconds * 1000
+            stats["max_ms"] = max(stats["max_ms"], seconds * 1000)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                name: {**stats, "avg_ms": stats["total_ms"] / stats["calls"]}
+                for name, stats in self._stats.items()
+            }
+
+
+stage_timings = StageTimings()
+
+
+def select_cleaning_stages(stages=None, skip_stages=None) -> list[str]:
+    """Returns the stage names to run, in pipeline order. Unknown names raise ValueError."""
+    for names in (stages, skip_stages):
+        if names is not None and not isinstance(names, list):
+            raise ValueError("'stages' und 'skip_stages' müssen Listen sein")
+    for name in (stages or []) + (skip_stages or []):
+        if name not in CLEANING_STAGES:
+            raise ValueError(f"Unbekannte Reinigungsstufe: '{name}'")
+    return [
+        name for name in CLEANING_STAGES
+        if (stages is None or name in stages) and name not in (skip_stages or [])
+    ]
+
+
+def clean_for_tts(text: str, stages: list[str] | None = None, timings: dict | None = None) -> str:
+    """
+    Runs the cleaning stages used by /speak (all of them by default).
+    The duration of each stage in ms is stored in `timings` if given.
+    """
+    for name in (stages if stages is not None else CLEANING_STAGES):
+        start = time.perf_counter()
+        text = CLEANING_STAGES[name](text)
+        elapsed = time.perf_counter() - start
+        stage_timings.record(name, elapsed)
+        metrics.observe('speak_cleaning_seconds', elapsed, stage=name)
+        if timings is not None:
+            timings[name] = round(elapsed * 1000, 3)
+    return text
 
 
 
@@ -390,6 +647,7 @@ def clean_text_with_libraries(text: str) -> str:
 
 def create_slug(text, min_word_len=4):
     # https://github.com/un33k/python-slugify
+    from slugify import slugify
     initial_slug = slugify(text, stopwords=MY_STOPWORDS, max_length=80)
 
 
@@ -400,6 +658,1383 @@ def create_slug(text, min_word_len=4):
 
     return '-'.join(long_words)
 
+
+# --- Warme Piper-Stimmen ---
+# Jede Stimme aus MODELS wird genau einmal geladen und bleibt danach im Speicher.
+# Bevorzugt wird das Python-Binding (pip install piper-tts). Ohne Binding läuft pro
+# Stimme ein dauerhafter `piper-tts --json-input` Prozess, der jede Zeile in eine
+# eigene WAV-Datei schreibt und deren Pfad auf stdout meldet.
+# Das Binding wird erst beim Laden der ersten Stimme importiert, weil es onnxruntime
+# und numpy nachzieht (None = noch nicht importiert, False = nicht installiert).
+PiperVoice = None
+
+
+def _piper_voice_class():
+    """The binding's PiperVoice, imported on first use; None without piper-tts."""
+    global PiperVoice
+    if PiperVoice is None:
+        try:
+            from piper import PiperVoice as voice_class
+        except ImportError:
+            voice_class = False
+        PiperVoice = voice_class
+    return PiperVoice or None
+
+
+class PiperError(RuntimeError):
+    """Raised when Piper fails to synthesize a text."""
+
+
+class JobCancelled(Exception):
+    """Raised inside a job that was stopped by a newer request or /stop."""
+
+
+class Cancellation:
+    """
+    Lets another thread stop a running job. Code that blocks on a
+    subprocess registers a callback (e.g. stopping playback) that runs as
+    soon as the job is cancelled.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise JobCancelled()
+
+    def add_callback(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+            cancelled = self._event.is_set()
+        if cancelled:
+            callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def _read_voice_sample_rate(model_path: str) -> int:
+    """Reads the sample rate from the voice's .onnx.json, falls back to SAMPLE_RATE."""
+    try:
+        with open(f"{model_path}.json", 'r') as f:
+            return int(json.load(f)['audio']['sample_rate'])
+    except (OSError, KeyError, ValueError, TypeError):
+        return SAMPLE_RATE
+
+
+class PiperEngine:
+    """
+    Keeps one Piper voice loaded and turns text into raw 16-bit mono PCM.
+
+    Piper itself is not thread-safe per voice, so every call is serialized
+    through a lock. A crashed subprocess is restarted on the next call.
+    """
+
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        self.sample_rate = _read_voice_sample_rate(model_path)
+        self._lock = threading.Lock()
+        self._voice = None
+        self._process = None
+        self._stderr_tail = deque(maxlen=20)
+        self._tmp_dir = None
+        self._counter = 0
+
+    def start(self):
+        with self._lock:
+            self._ensure_started()
+
+    def _ensure_started(self):
+        voice_class = _piper_voice_class()
+        if voice_class is not None:
+            if self._voice is None:
+                self._voice = voice_class.load(self.model_path)
+                self.sample_rate = self._voice.config.sample_rate
+            return
+
+        if self._process is not None and self._process.poll() is None:
+            return
+
+        if self._tmp_dir is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix='speak_server_piper_')
+        self._stderr_tail.clear()
+        self._process = subprocess.Popen(
+            [PIPER_CMD, "--model", self.model_path, "--json-input", "--output_dir", self._tmp_dir],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1
+        )
+        # stderr muss laufend geleert werden, sonst blockiert Piper irgendwann
+        threading.Thread(target=self._drain_stderr, args=(self._process,), daemon=True).start()
+
+    def _drain_stderr(self, process):
+        for line in process.stderr:
+            self._stderr_tail.append(line.rstrip())
+
+    def synthesize(self, text: str, cancellation: Cancellation | None = None) -> bytes:
+        with self._lock:
+            if cancellation is not None:
+                cancellation.check()
+            self._ensure_started()
+            model = Path(self.model_path).name
+            start = time.perf_counter()
+            try:
+                if self._voice is not None:
+                    audio = self._synthesize_in_process(text, cancellation)
+                else:
+                    audio = self._synthesize_subprocess(text, cancellation)
+            except PiperError:
+                metrics.inc('speak_piper_errors_total', model=model)
+                raise
+            elapsed = time.perf_counter() - start
+            audio_seconds = len(audio) / (self.sample_rate * SAMPLE_WIDTH * CHANNELS)
+            metrics.observe('speak_synthesis_seconds', elapsed, model=model)
+            metrics.inc('speak_synthesized_audio_seconds_total', audio_seconds, model=model)
+            if elapsed > 0 and audio_seconds > 0:
+                metrics.observe('speak_real_time_factor', audio_seconds / elapsed, model=model)
+            return audio
+
+    def _synthesize_in_process(self, text: str, cancellation: Cancellation | None) -> bytes:
+        # Das Binding liefert satzweise Stücke, dazwischen kann abgebrochen werden
+        if hasattr(self._voice, 'synthesize_stream_raw'):
+            pieces = self._voice.synthesize_stream_raw(text)
+        else:
+            pieces = (chunk.audio_int16_bytes for chunk in self._voice.synthesize(text))
+        audio = []
+        try:
+            for piece in pieces:
+                if cancellation is not None:
+                    cancellation.check()
+                audio.append(piece)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            raise PiperError(str(e)) from e
+        return b''.join(audio)
+
+    def _synthesize_subprocess(self, text: str, cancellation: Cancellation | None) -> bytes:
+        self._counter += 1
+        output_file = os.path.join(self._tmp_dir, f"{self._counter}.wav")
+        # Ein Abbruch beendet den Piper-Prozess; er wird beim nächsten Aufruf neu gestartet
+        kill = self._process.kill
+        if cancellation is not None:
+            cancellation.add_callback(kill)
+        try:
+            self._process.stdin.write(json.dumps({'text': text, 'output_file': output_file}) + '\n')
+            self._process.stdin.flush()
+            reported_path = self._process.stdout.readline().strip()
+        except (BrokenPipeError, OSError):
+            reported_path = ''
+        finally:
+            if cancellation is not None:
+                cancellation.remove_callback(kill)
+
+        if not reported_path:
+            self._process.kill()
+            self._process.wait()
+            if cancellation is not None:
+                cancellation.check()
+            raise PiperError('\n'.join(self._stderr_tail) or "Piper-Prozess wurde beendet")
+
+        try:
+            with wave.open(reported_path, 'rb') as wf:
+                self.sample_rate = wf.getframerate()
+                return wf.readframes(wf.getnframes())
+        except (OSError, wave.Error) as e:
+            raise PiperError(f"WAV von Piper nicht lesbar: {e}") from e
+        finally:
+            if os.path.exists(reported_path):
+                os.remove(reported_path)
+
+    def close(self):
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                self._process.stdin.close()
+                try:
+                    self._process.wait(timeout=2)
+                except subprocess.TimeoutExpired:
+                    self._process.kill()
+            self._process = None
+            self._voice = None
+            if self._tmp_dir is not None:
+                shutil.rmtree(self._tmp_dir, ignore_errors=True)
+                self._tmp_dir = None
+
+
+class VoicePool:
+    """
+    Hands out warm PiperEngines per model path, created on first use.
+
+    Engines are leased: `lease()` lends out idle copies of a voice and
+    creates new ones up to `max_per_voice`. When all copies are busy, the
+    caller waits, so concurrent requests never run more than
+    `max_per_voice` Piper instances of one voice at a time. While a copy
+    is still loading, callers wait for it instead of loading another one.
+    """
+
+    def __init__(self, models: dict, max_per_voice: int = VOICE_CONCURRENCY):
+        self.models = models
+        self.max_per_voice = max(1, max_per_voice)
+        self._engines = {}
+        self._idle = {}
+        self._loading = {}
+        self._available = threading.Condition()
+
+    @contextlib.contextmanager
+    def lease(self, model_path: str, count: int = 1, block: bool = True, warmup: str | None = None):
+        """
+        Lends up to `count` engines of a voice for the duration of the with
+        block. With `block`, waits until at least one is free; without it,
+        the list may be empty. Newly created engines first speak `warmup`,
+        if given, and count as loading until then.
+        """
+        engines, created = self._acquire(model_path, count, block)
+        try:
+            try:
+                for engine in engines:
+                    engine.start()
+                    if warmup is not None and engine in created:
+                        engine.synthesize(warmup)
+            finally:
+                if created:
+                    with self._available:
+                        self._loading[model_path] -= len(created)
+                        self._available.notify_all()
+            yield engines
+        finally:
+            with self._available:
+                self._idle[model_path].extend(engines)
+                self._available.notify_all()
+
+    def _acquire(self, model_path: str, count: int, block: bool) -> tuple[list[PiperEngine], list[PiperEngine]]:
+        """Returns the leased engines and which of them were newly created."""
+        with self._available:
+            all_engines = self._engines.setdefault(model_path, [])
+            idle = self._idle.setdefault(model_path, [])
+            while block and not idle and (len(all_engines) >= self.max_per_voice or self._loading.get(model_path)):
+                self._available.wait()
+            engines = []
+            while len(engines) < count and idle:
+                engines.append(idle.pop())
+            created = []
+            while len(engines) < count and len(all_engines) < self.max_per_voice:
+                engine = PiperEngine(model_path)
+                all_engines.append(engine)
+                engines.append(engine)
+                created.append(engine)
+            self._loading[model_path] = self._loading.get(model_path, 0) + len(created)
+            return engines, created
+
+    def close_all(self):
+        with self._available:
+            engines = [engine for copies in self._engines.values() for engine in copies]
+            self._engines.clear()
+            self._idle.clear()
+        for engine in engines:
+            engine.close()
+
+
+# --- Synthese-Cache ---
+class SynthesisCache:
+    """
+    LRU cache from (cleaned text, model path, sample rate) to raw PCM.
+
+    Entries live in memory up to `max_bytes`. If `disk_dir` is set, every
+    entry is also written there as <sha256>.pcm, and the directory is kept
+    below `disk_max_bytes` by removing the least recently used files.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str | None = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._disk_entries = OrderedDict()
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            files = [entry for entry in os.scandir(disk_dir) if entry.name.endswith('.pcm')]
+            for entry in sorted(files, key=lambda e: e.stat().st_mtime):
+                size = entry.stat().st_size
+                self._disk_entries[entry.name[:-4]] = size
+                self._disk_size += size
+
+    @staticmethod
+    def make_key(text: str, model_path: str, sample_rate: int) -> str:
+        return hashlib.sha256(f"{model_path}\0{sample_rate}\0{text}".encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            audio = self._entries.get(key)
+            if audio is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return audio
+            if key in self._disk_entries:
+                path = os.path.join(self.disk_dir, f"{key}.pcm")
+                try:
+                    with open(path, 'rb') as f:
+                        audio = f.read()
+                    os.utime(path)
+                    self._disk_entries.move_to_end(key)
+                    self._remember(key, audio)
+                    self.hits += 1
+                    return audio
+                except OSError:
+                    self._disk_size -= self._disk_entries.pop(key)
+            self.misses += 1
+            return None
+
+    def contains(self, key: str) -> bool:
+        """Whether `key` is cached in memory or on disk; unlike get() it counts no hit or miss."""
+        with self._lock:
+            return key in self._entries or key in self._disk_entries
+
+    def put(self, key: str, audio: bytes):
+        with self._lock:
+            self._remember(key, audio)
+            if self.disk_dir and key not in self._disk_entries and len(audio) <= self.disk_max_bytes:
+                try:
+                    with open(os.path.join(self.disk_dir, f"{key}.pcm"), 'wb') as f:
+                        f.write(audio)
+                except OSError as e:
+                    print(f"!!! FEHLER beim Schreiben des Caches: {e}")
+                    return
+                self._disk_entries[key] = len(audio)
+                self._disk_size += len(audio)
+                while self._disk_size > self.disk_max_bytes:
+                    old_key, old_size = self._disk_entries.popitem(last=False)
+                    self._disk_size -= old_size
+                    try:
+                        os.remove(os.path.join(self.disk_dir, f"{old_key}.pcm"))
+                    except OSError:
+                        pass
+
+    def _remember(self, key: str, audio: bytes):
+        if len(audio) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key))
+        self._entries[key] = audio
+        self._size += len(audio)
+        while self._size > self.max_bytes:
+            _, old_audio = self._entries.popitem(last=False)
+            self._size -= len(old_audio)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "disk_entries": len(self._disk_entries),
+                "disk_bytes": self._disk_size,
+            }
+
+
+def synthesize_cached(engine: PiperEngine, text: str, cancellation: Cancellation | None = None) -> bytes:
+    """Returns the PCM for `text` from the cache, synthesizing it on a miss."""
+    if synthesis_cache is None:
+        return engine.synthesize(text, cancellation)
+    key = SynthesisCache.make_key(text, engine.model_path, engine.sample_rate)
+    audio = synthesis_cache.get(key)
+    if audio is None:
+        audio = engine.synthesize(text, cancellation)
+        if audio:
+            synthesis_cache.put(key, audio)
+    return audio
+
+
+# --- Satzweises Streaming ---
+SENTENCE_END_RE = re.compile(r'(?<=[.!?])\s+')
+# Sitzungen: ein Satz ist fertig, wenn nach dem Satzzeichen Leerraum folgt oder die Zeile endet
+SESSION_BOUNDARY_RE = re.compile(r'[.!?]\s+|\n')
+
+
+def split_sentences(text: str, min_chars: int = STREAM_MIN_SENTENCE_CHARS) -> list[str]:
+    """
+    Splits cleaned text into sentences for streaming synthesis.
+
+    Very short sentences are merged with the following one. The first
+    chunk is never merged, so playback can start as early as possible.
+    """
+    chunks = []
+    for sentence in SENTENCE_END_RE.split(text.strip()):
+        if not sentence:
+            continue
+        if len(chunks) > 1 and len(chunks[-1]) < min_chars:
+            chunks[-1] = f"{chunks[-1]} {sentence}"
+        else:
+            chunks.append(sentence)
+    return chunks
+
+
+def iter_synthesized(engine: PiperEngine, sentences: list[str], prefetch: int = STREAM_PREFETCH,
+                     cancellation: Cancellation | None = None):
+    """
+    Yields the PCM of each sentence in order while the next ones are
+    synthesized in a background thread. Piper errors are re-raised here.
+    """
+    chunks = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        # Gibt auf, sobald der Verbraucher weg ist, sonst hinge der Thread für immer
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for sentence in sentences:
+                if not put(synthesize_cached(engine, sentence, cancellation)):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+# --- Audioausgabe ---
+# Das Audiogerät bleibt für die ganze Laufzeit offen. Bevorzugt über PulseAudio/PipeWire
+# (pip install pasimple) oder ALSA (pip install pyalsaaudio); ohne Binding über einen
+# dauerhaft laufenden aplay-Prozess. 'null' verwirft alles, 'file:PFAD' schreibt eine WAV.
+class AplaySink:
+    """One long-running `aplay` process, restarted only when the sample rate changes."""
+
+    name = 'aplay'
+
+    def __init__(self):
+        self._process = None
+        self._rate = None
+
+    def open(self, sample_rate: int):
+        if self._process is not None and self._process.poll() is None and self._rate == sample_rate:
+            return
+        self.close()
+        aplay_cmd = f"aplay -q -r {sample_rate} -f S16_LE -t raw --buffer-time={APLAY_BUFFER_US} -"
+        self._process = subprocess.Popen(shlex.split(aplay_cmd), stdin=subprocess.PIPE)
+        # Kleiner Pipe-Puffer, damit die gemeldete Position nicht eine Sekunde vorausläuft
+        try:
+            fcntl.fcntl(self._process.stdin, getattr(fcntl, 'F_SETPIPE_SZ', 1031), 4096)
+        except OSError:
+            pass
+        self._rate = sample_rate
+
+    def write(self, data):
+        try:
+            self._process.stdin.write(data)
+            self._process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            # aplay ist abgestürzt: beim nächsten open() neu starten
+            self._rate = None
+
+    def latency(self) -> float:
+        return APLAY_BUFFER_US / 1_000_000
+
+    def drop(self):
+        # Was schon in aplay steckt, lässt sich nur durch Beenden verwerfen
+        self.close()
+
+    def close(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+        self._rate = None
+
+
+class PulseSink:
+    """PulseAudio or PipeWire (pipewire-pulse) through the `pasimple` binding."""
+
+    name = 'pulse'
+
+    def __init__(self):
+        import pasimple
+        self._pasimple = pasimple
+        self._stream = None
+        self._rate = None
+
+    def open(self, sample_rate: int):
+        if self._stream is not None and self._rate == sample_rate:
+            return
+        self.close()
+        self._stream = self._pasimple.PaSimple(
+            self._pasimple.PA_STREAM_PLAYBACK, self._pasimple.PA_SAMPLE_S16LE, CHANNELS, sample_rate,
+            'speak_server', 'Sprachausgabe')
+        self._rate = sample_rate
+
+    def write(self, data):
+        self._stream.write(bytes(data))
+
+    def latency(self) -> float:
+        return self._stream.get_latency() / 1_000_000 if self._stream is not None else 0.0
+
+    def drop(self):
+        if self._stream is not None:
+            self._stream.flush()
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
+class AlsaSink:
+    """ALSA through the `pyalsaaudio` binding."""
+
+    name = 'alsa'
+
+    def __init__(self):
+        import alsaaudio
+        self._alsaaudio = alsaaudio
+        self._pcm = None
+        self._rate = None
+
+    def open(self, sample_rate: int):
+        if self._pcm is not None and self._rate == sample_rate:
+            return
+        self.close()
+        self._pcm = self._alsaaudio.PCM(
+            self._alsaaudio.PCM_PLAYBACK, device=ALSA_DEVICE, channels=CHANNELS, rate=sample_rate,
+            format=self._alsaaudio.PCM_FORMAT_S16_LE, periodsize=sample_rate * AUDIO_PERIOD_MS // 1000, periods=4)
+        self._rate = sample_rate
+
+    def write(self, data):
+        self._pcm.write(data)
+
+    def latency(self) -> float:
+        return 4 * AUDIO_PERIOD_MS / 1000
+
+    def drop(self):
+        if self._pcm is not None and hasattr(self._pcm, 'drop'):
+            self._pcm.drop()
+
+    def close(self):
+        if self._pcm is not None:
+            self._pcm.close()
+            self._pcm = None
+
+
+class NullSink:
+    """Discards all audio at once; for tests and benchmarks."""
+
+    name = 'null'
+
+    def open(self, sample_rate: int):
+        pass
+
+    def write(self, data):
+        pass
+
+    def latency(self) -> float:
+        return 0.0
+
+    def drop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink:
+    """Appends all audio to one WAV file, resampled to the first sample rate; for tests."""
+
+    name = 'file'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._wav = None
+        self._file_rate = None
+        self._rate = None
+
+    def open(self, sample_rate: int):
+        if self._wav is None:
+            self._wav = wave.open(self.path, 'wb')
+            self._wav.setnchannels(CHANNELS)
+            self._wav.setsampwidth(SAMPLE_WIDTH)
+            self._wav.setframerate(sample_rate)
+            self._file_rate = sample_rate
+        self._rate = sample_rate
+
+    def write(self, data):
+        self._wav.writeframes(resample_pcm(bytes(data), self._rate, self._file_rate))
+
+    def latency(self) -> float:
+        return 0.0
+
+    def drop(self):
+        pass
+
+    def close(self):
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+
+
+def create_audio_sink(spec: str = AUDIO_SINK):
+    """Builds the sink for --audio-sink: auto, pulse, alsa, aplay, null or file:PATH."""
+    if spec.startswith('file:'):
+        return FileSink(spec[len('file:'):])
+    sinks = {'pulse': PulseSink, 'alsa': AlsaSink, 'aplay': AplaySink, 'null': NullSink}
+    if spec != 'auto' and spec not in sinks:
+        raise ValueError(f"Unbekannte Audioausgabe: '{spec}'")
+    if spec != 'auto':
+        return sinks[spec]()
+    for sink_class in (PulseSink, AlsaSink):
+        try:
+            return sink_class()
+        except ImportError:
+            pass
+    return AplaySink()
+
+
+class Playback:
+    """
+    One utterance on the AudioOutput: queue chunks with `write()`, wait for
+    the end with `drain()`, cut it off with `stop()`. `position` is how
+    many seconds of it have actually come out of the speakers. If the
+    sound device fails, the playback stops and `drain()` raises the error.
+    """
+
+    def __init__(self, output, sample_rate: int):
+        self.output = output
+        self.sample_rate = sample_rate
+        self.queued_frames = 0
+        self.written_frames = 0
+        self.stopped = False
+        self.finished = False
+        self.error = None
+        self._drained = threading.Event()
+
+    def write(self, chunk: bytes):
+        """Queues the chunk in short periods (views, not copies); blocks while the queue is full."""
+        view = memoryview(chunk)
+        period_bytes = max(2, self.sample_rate * AUDIO_PERIOD_MS // 1000) * SAMPLE_WIDTH * CHANNELS
+        for offset in range(0, len(view), period_bytes):
+            if self.stopped:
+                return
+            period = view[offset:offset + period_bytes]
+            self.queued_frames += len(period) // (SAMPLE_WIDTH * CHANNELS)
+            self.output._queue.put((self, period))
+
+    def drain(self):
+        """Waits until everything queued has been played (or the playback was stopped)."""
+        self.output._queue.put((self, None))
+        self._drained.wait()
+        if self.error is not None:
+            raise RuntimeError(f"Audioausgabe fehlgeschlagen: {self.error}") from self.error
+        if not self.stopped:
+            # Das Gerät spielt den Rest seines Puffers noch ab
+            time.sleep(max(0.0, self.output.sink.latency()))
+        self.finished = True
+
+    def stop(self):
+        if not self.stopped:
+            self.stopped = True
+            self.output._drop(self)
+
+    @property
+    def position(self) -> float:
+        if self.finished:
+            return self.written_frames / self.sample_rate
+        latency_frames = self.output.sink.latency() * self.sample_rate
+        return max(0.0, self.written_frames - latency_frames) / self.sample_rate
+
+    @property
+    def duration(self) -> float:
+        """Seconds queued so far."""
+        return self.queued_frames / self.sample_rate
+
+
+class AudioOutput:
+    """
+    Plays PCM on one persistent sink from a bounded queue on its own thread.
+    Consecutive chunks and utterances follow each other without a gap or a
+    new process; the device is only reopened when the sample rate changes.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.current = None
+        self._queue = queue.Queue(maxsize=max(1, AUDIO_QUEUE_MS // AUDIO_PERIOD_MS))
+        self._lock = threading.Lock()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def open(self, sample_rate: int) -> Playback:
+        return Playback(self, sample_rate)
+
+    def _work(self):
+        while True:
+            playback, period = self._queue.get()
+            if period is None:
+                playback._drained.set()
+                continue
+            if playback.stopped:
+                continue
+            try:
+                with self._lock:
+                    self.current = playback
+                    self.sink.open(playback.sample_rate)
+                    self.sink.write(period)
+            except Exception as e:
+                # Nur diese Wiedergabe scheitert; der Thread läuft weiter und öffnet das Gerät beim nächsten Mal neu
+                print(f"!!! FEHLER bei der Audioausgabe ({self.sink.name}): {e}")
+                playback.error = e
+                playback.stopped = True
+                with contextlib.suppress(Exception), self._lock:
+                    self.sink.close()
+                continue
+            playback.written_frames += len(period) // (SAMPLE_WIDTH * CHANNELS)
+
+    def _drop(self, playback: Playback):
+        # Noch wartende Perioden verwirft der Thread selbst (playback.stopped);
+        # hier wird nur das geleert, was schon im Gerät steckt.
+        with self._lock:
+            if self.current is playback:
+                self.sink.drop()
+
+    def status(self) -> dict:
+        playback = self.current
+        playing = playback is not None and not playback.finished and not playback.stopped
+        return {
+            "sink": self.sink.name,
+            "playing": playing,
+            "position": round(playback.position, 3) if playing else None,
+            "duration": round(playback.duration, 3) if playing else None,
+            "sample_rate": playback.sample_rate if playing else None,
+        }
+
+    def close(self):
+        with self._lock:
+            self.sink.close()
+
+
+def play_pcm_chunks(chunks, sample_rate: int, on_chunk=None, cancellation: Cancellation | None = None,
+                    started: float | None = None, consumers=(), on_playback=None) -> int:
+    """
+    Plays raw PCM chunks on the shared AudioOutput as they arrive, without
+    gaps between them, and returns how many bytes were played. Every chunk
+    is also passed, by reference and before it goes to the player, to each
+    of `consumers` (archive, live listeners), so nothing is copied or
+    collected. `on_chunk(0)` is called when the first chunk goes to the
+    player and `on_chunk(count)` after each chunk has been queued (which
+    blocks until the player has room), `on_playback(playback)` once at
+    the start (for the position).
+    Cancelling stops the sound immediately and raises JobCancelled.
+    `started` (time.time() at the start of the job) is used for the
+    time-to-first-audio metric.
+    """
+    playback = audio_output.open(sample_rate)
+    if on_playback is not None:
+        on_playback(playback)
+    if cancellation is not None:
+        cancellation.add_callback(playback.stop)
+    played_chunks = 0
+    played_bytes = 0
+    first_audio = None
+    try:
+        for chunk in chunks:
+            if playback.stopped:
+                break
+            if not played_chunks:
+                print("Erster Audio-Abschnitt bereit, starte Wiedergabe...")
+                first_audio = time.perf_counter()
+                if started is not None:
+                    metrics.observe('speak_time_to_first_audio_seconds', time.time() - started)
+                if on_chunk is not None:
+                    on_chunk(0)
+            for consumer in consumers:
+                consumer(chunk)
+            played_chunks += 1
+            played_bytes += len(chunk)
+            playback.write(chunk)
+            if on_chunk is not None:
+                on_chunk(played_chunks)
+        playback.drain()
+    finally:
+        # Ein abgebrochener Erzeuger räumt sofort auf, nicht erst, wenn er eingesammelt wird
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        if cancellation is not None:
+            cancellation.remove_callback(playback.stop)
+        if first_audio is not None:
+            metrics.observe('speak_playback_seconds', time.perf_counter() - first_audio)
+    if cancellation is not None:
+        cancellation.check()
+    return played_bytes
+
+
+class AudioRing:
+    """
+    The most recent PCM chunks of one job, shared by reference with any
+    number of live listeners. The player never waits for a listener; one
+    that falls more than `capacity` chunks behind skips ahead. The chunks
+    are released once the job is over and the last listener has left.
+    """
+
+    def __init__(self, capacity: int = AUDIO_RING_CHUNKS):
+        self.sample_rate = None
+        self._chunks = deque(maxlen=capacity)
+        self._next = 0  # Nummer des nächsten geschriebenen Abschnitts
+        self._listeners = 0
+        self._closed = False
+        self._changed = threading.Condition()
+
+    def start(self, sample_rate: int):
+        with self._changed:
+            self.sample_rate = sample_rate
+            self._changed.notify_all()
+
+    def write(self, chunk: bytes):
+        with self._changed:
+            self._chunks.append(chunk)
+            self._next += 1
+            self._changed.notify_all()
+
+    def close(self):
+        with self._changed:
+            self._closed = True
+            if not self._listeners:
+                self._chunks.clear()
+            self._changed.notify_all()
+
+    def wait_started(self) -> int | None:
+        """Waits until playback starts; returns its sample rate, or None if the job ended without audio."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.sample_rate is not None or self._closed)
+            return self.sample_rate
+
+    def listen(self):
+        """Yields the buffered chunks and then every new one until the job is over."""
+        with self._changed:
+            self._listeners += 1
+            position = self._next - len(self._chunks)
+        try:
+            while True:
+                with self._changed:
+                    self._changed.wait_for(lambda: position < self._next or self._closed)
+                    oldest = self._next - len(self._chunks)
+                    position = max(position, oldest)
+                    if position >= self._next:
+                        return
+                    chunk = self._chunks[position - oldest]
+                position += 1
+                yield chunk
+        finally:
+            with self._changed:
+                self._listeners -= 1
+                if self._closed and not self._listeners:
+                    self._chunks.clear()
+
+
+def wav_stream_header(sample_rate: int) -> bytes:
+    """
+    WAV header for audio of unknown length. The RIFF and data sizes are set
+    to the maximum, which browsers and players treat as "read until EOF".
+    """
+    byte_rate = sample_rate * CHANNELS * SAMPLE_WIDTH
+    return (
+        b'RIFF' + struct.pack('<I', 0xFFFFFFFF) + b'WAVE'
+        + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, CHANNELS, sample_rate, byte_rate,
+                                CHANNELS * SAMPLE_WIDTH, SAMPLE_WIDTH * 8)
+        + b'data' + struct.pack('<I', 0xFFFFFFFF)
+    )
+
+
+# --- Parallele Synthese langer Texte ---
+def group_sentences(sentences: list[str], target_chars: int = PARALLEL_CHUNK_CHARS) -> list[str]:
+    """Joins consecutive sentences into chunks of roughly `target_chars`."""
+    chunks = []
+    for sentence in sentences:
+        if chunks and len(chunks[-1]) + len(sentence) < target_chars:
+            chunks[-1] = f"{chunks[-1]} {sentence}"
+        else:
+            chunks.append(sentence)
+    return chunks
+
+
+def smooth_chunk_edges(pcm: bytes, sample_rate: int, fade_ms: int = CHUNK_FADE_MS) -> bytes:
+    """
+    Fades the first and last few milliseconds of a 16-bit chunk in and out,
+    so independently synthesized chunks join without an audible click.
+    """
+    samples = array('h')
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % 2])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    fade = min(len(samples) // 2, sample_rate * fade_ms // 1000)
+    for i in range(fade):
+        factor = i / fade
+        samples[i] = int(samples[i] * factor)
+        samples[-1 - i] = int(samples[-1 - i] * factor)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def resample_pcm(pcm: bytes, from_rate: int, to_rate: int) -> bytes:
+    """Converts 16-bit mono PCM from one sample rate to another."""
+    if from_rate == to_rate or not pcm:
+        return pcm
+    if audioop is not None:
+        return audioop.ratecv(pcm, SAMPLE_WIDTH, CHANNELS, from_rate, to_rate, None)[0]
+
+    # Fallback ohne audioop: lineare Interpolation
+    samples = array('h')
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % 2])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    count = len(samples) * to_rate // from_rate
+    step = from_rate / to_rate
+    last = len(samples) - 1
+    resampled = array('h', bytes(2 * count))
+    for i in range(count):
+        position = i * step
+        left = int(position)
+        right = min(left + 1, last)
+        fraction = position - left
+        resampled[i] = int(samples[left] + (samples[right] - samples[left]) * fraction)
+    if sys.byteorder == 'big':
+        resampled.byteswap()
+    return resampled.tobytes()
+
+
+def iter_in_order(executor, calls, ahead: int):
+    """
+    Runs `calls` ((function, *args) tuples) on `executor` and yields their
+    results in order. At most `ahead` of them are submitted and not yet
+    consumed, so finished audio never piles up ahead of the playback.
+    """
+    pending = deque()
+    for call in calls:
+        pending.append(executor.submit(*call))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+@contextlib.contextmanager
+def synthesis_executor(workers: int, cancellation: Cancellation | None):
+    """
+    A thread pool plus a Cancellation for its work that also follows the
+    job's `cancellation`. On exit, work still running is cancelled and
+    awaited, so no engine is busy any more when the caller hands it back
+    to the VoicePool (after an error, or when playback stopped early).
+    """
+    stop = Cancellation()
+    if cancellation is not None:
+        cancellation.add_callback(stop.cancel)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        yield executor, stop
+    finally:
+        stop.cancel()
+        executor.shutdown(wait=True, cancel_futures=True)
+        if cancellation is not None:
+            cancellation.remove_callback(stop.cancel)
+
+
+def iter_parallel_synthesized(engines: list[PiperEngine], chunks: list[str],
+                              cancellation: Cancellation | None = None):
+    """
+    Synthesizes the chunks concurrently, one chunk per free engine, and
+    yields the audio strictly in the original order.
+    """
+    free_engines = queue.Queue()
+    for engine in engines:
+        free_engines.put(engine)
+
+    def work(text, stop):
+        engine = free_engines.get()
+        try:
+            return synthesize_cached(engine, text, stop)
+        finally:
+            free_engines.put(engine)
+
+    with synthesis_executor(len(engines), cancellation) as (executor, stop):
+        calls = ((work, chunk, stop) for chunk in chunks)
+        for audio in iter_in_order(executor, calls, len(engines) + STREAM_PREFETCH):
+            yield smooth_chunk_edges(audio, engines[0].sample_rate)
+
+
+# --- Gemischte Sprachen ---
+def segment_by_language(text: str, text_lang: str) -> list[tuple[str, str]]:
+    """
+    Splits text into (language, text) segments. Every sentence is detected
+    on its own (in one batch), then neighbours of the same language merge.
+    Sentences too short or unclear to judge ("Yes.") keep `text_lang`, the
+    language of the whole text, instead of switching to the default voice.
+    """
+    sentences = split_sentences(text, min_chars=0)
+    segments = []
+    for sentence, lang_code in zip(sentences, language_detector.detect_many(sentences, fallback=text_lang)):
+        if segments and segments[-1][0] == lang_code:
+            segments[-1] = (lang_code, f"{segments[-1][1]} {sentence}")
+        else:
+            segments.append((lang_code, sentence))
+    return segments
+
+
+def iter_routed_synthesized(segments: list[tuple[str, str]], engines: dict, output_rate: int,
+                            cancellation: Cancellation | None = None):
+    """
+    Synthesizes every segment with the voice of its language. Different
+    voices work at the same time; the audio is yielded in the original
+    order and resampled to `output_rate` where a voice differs.
+    """
+    with synthesis_executor(len(engines), cancellation) as (executor, stop):
+        calls = ((synthesize_cached, engines[lang_code], segment, stop) for lang_code, segment in segments)
+        for (lang_code, _), audio in zip(segments, iter_in_order(executor, calls, len(engines) + STREAM_PREFETCH)):
+            audio = resample_pcm(audio, engines[lang_code].sample_rate, output_rate)
+            yield smooth_chunk_edges(audio, output_rate)
+
+
+# --- Archiv ---
+class ArchiveStream:
+    """
+    One utterance that is archived while it is still being spoken. Chunks
+    passed to `write()` are queued by reference, never copied, and written
+    by the ArchiveWriter thread as they arrive. `text` and `metadata` may
+    still change until `finish()`, for text that is still growing.
+    """
+
+    def __init__(self, created, base_path: str, audio_path: str, text: str, sample_rate: int, metadata: dict):
+        self.created = created
+        self.base_path = base_path
+        self.audio_path = audio_path
+        self.text = text
+        self.sample_rate = sample_rate
+        self.metadata = metadata
+        self._chunks = queue.Queue()
+
+    def write(self, chunk: bytes):
+        self._chunks.put(chunk)
+
+    def finish(self):
+        """All audio was written; the utterance goes into the index."""
+        self._chunks.put(ArchiveWriter.FINISH)
+
+    def abort(self):
+        """Nothing is kept, e.g. after a cancelled job."""
+        self._chunks.put(ArchiveWriter.ABORT)
+
+
+class ArchiveWriter:
+    """
+    Saves every spoken text as {timestamp}_{slug}.txt plus its audio on a
+    background thread, so encoding and disk I/O never delay playback.
+
+    Audio arrives chunk by chunk through an ArchiveStream while it plays
+    and is written as WAV, or piped into the `flac` or `opusenc` command
+    line encoder. If the encoder is missing, WAV is written instead; if it
+    fails halfway, the recording is dropped.
+    """
+
+    FINISH = object()
+    ABORT = object()
+
+    def __init__(self, directory: str, audio_format: str = 'wav', index=None):
+        self.directory = directory
+        self.audio_format = audio_format
+        self.index = index
+        self._queue = queue.Queue()
+        os.makedirs(directory, exist_ok=True)
+        if audio_format != 'wav' and shutil.which(ARCHIVE_ENCODERS[audio_format][0]) is None:
+            print(f"WARNUNG: '{ARCHIVE_ENCODERS[audio_format][0]}' nicht gefunden, Archiv wird als WAV gespeichert.")
+            self.audio_format = 'wav'
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def open_stream(self, text: str, sample_rate: int, slug: str, metadata: dict | None = None) -> ArchiveStream:
+        """
+        Starts archiving one utterance. `metadata` (language, model,
+        text_hash, spoken_text) goes into the index once the stream is
+        finished; `stream.audio_path` is where the audio will be. The file
+        is reserved right away, so two utterances never share a name.
+        """
+        now = datetime.datetime.now()
+        stem = os.path.join(self.directory, f"{now.strftime('%Y-%m-%d_%H-%M-%S-%f')}_{slug}")
+        for attempt in itertools.count():
+            base_path = stem if attempt == 0 else f"{stem}_{attempt}"
+            try:
+                os.close(os.open(f"{base_path}.{self.audio_format}", os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                continue
+        stream = ArchiveStream(now, base_path, f"{base_path}.{self.audio_format}", text, sample_rate, metadata or {})
+        self._queue.put(stream)
+        return stream
+
+    def flush(self):
+        """Blocks until every finished stream is on disk."""
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            stream = self._queue.get()
+            try:
+                self._write_stream(stream)
+            except Exception as e:
+                # Dies ist kein kritischer Fehler, die Wiedergabe läuft davon unabhängig
+                print(f"!!! FEHLER beim Speichern im Archiv: {e}")
+                # Die in open_stream() reservierte, noch leere Datei nicht liegen lassen
+                with contextlib.suppress(OSError):
+                    if os.path.getsize(stream.audio_path) == 0:
+                        os.remove(stream.audio_path)
+            finally:
+                self._queue.task_done()
+
+    def _write_stream(self, stream: ArchiveStream):
+        text_path = f"{stream.base_path}.txt"
+        # Gemessen wird nur die eigene Arbeit, nicht das Warten auf die Wiedergabe
+        start = time.perf_counter()
+        sink = self._open_sink(stream)
+        busy = time.perf_counter() - start
+        size = 0
+        failed = False
+        while True:
+            chunk = stream._chunks.get()
+            start = time.perf_counter()
+            if chunk is self.FINISH or chunk is self.ABORT:
+                break
+            if failed:
+                continue
+            try:
+                sink.write(chunk)
+                size += len(chunk)
+            except (OSError, ValueError) as e:
+                print(f"!!! FEHLER beim Schreiben von '{stream.audio_path}': {e}")
+                failed = True
+            busy += time.perf_counter() - start
+
+        try:
+            ok = sink.close() and not failed and chunk is self.FINISH and size > 0
+            if not ok:
+                if os.path.exists(stream.audio_path):
+                    os.remove(stream.audio_path)
+                return
+            with open(text_path, "w") as text_file:
+                text_file.write(stream.text)
+            print(f"Audio erfolgreich in '{stream.audio_path}' gespeichert.")
+            if self.index is not None:
+                self.index.add(
+                    created=stream.created,
+                    duration=size / (stream.sample_rate * SAMPLE_WIDTH * CHANNELS),
+                    sample_rate=stream.sample_rate,
+                    audio_path=os.path.abspath(stream.audio_path),
+                    audio_size=os.path.getsize(stream.audio_path),
+                    text_path=os.path.abspath(text_path),
+                    **stream.metadata
+                )
+        finally:
+            metrics.observe('speak_archive_write_seconds', busy + time.perf_counter() - start)
+
+    def _open_sink(self, stream: ArchiveStream):
+        if self.audio_format != 'wav':
+            command = [part.format(rate=stream.sample_rate, path=stream.audio_path)
+                       for part in ARCHIVE_ENCODERS[self.audio_format]]
+            try:
+                return _EncoderSink(command)
+            except OSError as e:
+                print(f"!!! FEHLER beim Starten von {command[0]}, speichere als WAV: {e}")
+                stream.audio_path = f"{stream.base_path}.wav"
+        return _WavSink(stream.audio_path, stream.sample_rate)
+
+
+class _EncoderSink:
+    """Pipes raw PCM into an encoder process; close() reports whether it succeeded."""
+
+    def __init__(self, command: list[str]):
+        self.command = command
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.PIPE)
+
+    def write(self, chunk: bytes):
+        self._process.stdin.write(chunk)
+
+    def close(self) -> bool:
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        stderr = self._process.stderr.read()
+        if self._process.wait() != 0:
+            print(f"!!! FEHLER von {self.command[0]}: {stderr.decode('utf-8', 'replace')}")
+            return False
+        return True
+
+
+class _WavSink:
+    """Writes raw PCM into a WAV file; the header sizes are fixed on close()."""
+
+    def __init__(self, path: str, sample_rate: int):
+        self._wav = wave.open(path, 'wb')
+        self._wav.setnchannels(CHANNELS)
+        self._wav.setsampwidth(SAMPLE_WIDTH)
+        self._wav.setframerate(sample_rate)
+
+    def write(self, chunk: bytes):
+        self._wav.writeframesraw(chunk)
+
+    def close(self) -> bool:
+        self._wav.close()
+        return True
+
+
+class ArchiveIndex:
+    """
+    SQLite index of every archived utterance: when it was spoken, language,
+    voice, a hash of the spoken text, duration and file paths. Lets the
+    server search the archive and replay a recording of identical text
+    instead of synthesizing it again.
+    """
+
+    COLUMNS = ('id', 'created', 'language', 'model', 'text_hash', 'duration', 'sample_rate',
+               'audio_path', 'audio_size', 'text_path', 'spoken_text')
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS utterances (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created TEXT NOT NULL,
+                    language TEXT,
+                    model TEXT,
+                    text_hash TEXT,
+                    duration REAL,
+                    sample_rate INTEGER,
+                    audio_path TEXT NOT NULL,
+                    audio_size INTEGER,
+                    text_path TEXT,
+                    spoken_text TEXT
+                )
+            """)
+            # Ältere Archive haben noch keine Spalte für die Dateigröße
+            if 'audio_size' not in {row[1] for row in self._db.execute("PRAGMA table_info(utterances)")}:
+                self._db.execute("ALTER TABLE utterances ADD COLUMN audio_size INTEGER")
+            self._db.execute("CREATE INDEX IF NOT EXISTS utterances_text_hash ON utterances (text_hash, model)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS utterances_created ON utterances (created)")
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def add(self, created, language=None, model=None, text_hash=None, duration=None, sample_rate=None,
+            audio_path=None, audio_size=None, text_path=None, spoken_text=None) -> int:
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO utterances (created, language, model, text_hash, duration, sample_rate,"
+                " audio_path, audio_size, text_path, spoken_text) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (created.isoformat(timespec='seconds'), language, model, text_hash, duration, sample_rate,
+                 audio_path, audio_size, text_path, spoken_text)
+            )
+            return cursor.lastrowid
+
+    def get(self, utterance_id: int) -> dict | None:
+        rows = self._select("WHERE id = ?", (utterance_id,))
+        return rows[0] if rows else None
+
+    def find_recording(self, text_hash: str, model: str) -> dict | None:
+        """
+        Newest recording of the same text with the same voice whose file is
+        still the one that was indexed (same size); others were replaced or
+        lost and are not trusted.
+        """
+        for row in self._select("WHERE text_hash = ? AND model = ? ORDER BY id DESC LIMIT 5", (text_hash, model)):
+            try:
+                if row['audio_size'] is not None and os.path.getsize(row['audio_path']) == row['audio_size']:
+                    return row
+            except OSError:
+                pass
+        return None
+
+    def search(self, query: str | None = None, language: str | None = None, since: str | None = None,
+               until: str | None = None, limit: int = 50) -> list[dict]:
+        conditions, params = [], []
+        if query:
+            conditions.append("spoken_text LIKE ?")
+            params.append(f"%{query}%")
+        if language:
+            conditions.append("language = ?")
+            params.append(language)
+        if since:
+            conditions.append("created >= ?")
+            params.append(since)
+        if until:
+            conditions.append("created <= ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        return self._select(f"{where}ORDER BY id DESC LIMIT ?", (*params, limit))
+
+    def _select(self, clause: str, params: tuple) -> list[dict]:
+        with self._lock:
+            rows = self._db.execute(f"SELECT {', '.join(self.COLUMNS)} FROM utterances {clause}", params).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+
+def load_archived_audio(audio_path: str, sample_rate: int) -> bytes | None:
+    """Reads an archived recording back into raw PCM, or None if that fails."""
+    try:
+        if audio_path.endswith('.wav'):
+            with wave.open(audio_path, 'rb') as wf:
+                return wf.readframes(wf.getnframes())
+        if audio_path.endswith('.flac'):
+            command = ["flac", "--silent", "--decode", "--stdout", "--force-raw-format",
+                       "--endian=little", "--sign=signed", audio_path]
+        elif audio_path.endswith('.opus'):
+            command = ["opusdec", "--quiet", "--rate", str(sample_rate), audio_path, "-"]
+        else:
+            return None
+        decoder = subprocess.run(command, capture_output=True)
+        return decoder.stdout if decoder.returncode == 0 else None
+    except (OSError, wave.Error) as e:
+        print(f"!!! FEHLER beim Lesen von '{audio_path}': {e}")
+        return None
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     '--no-save',
@@ -407,8 +2042,129 @@ parser.add_argument(
     dest='save',
     help="Audio nur ausgeben, nicht speichern."
 )
+parser.add_argument(
+    '--socket',
+    default=SOCKET_PATH,
+    help=f"Unix-Socket für lokale Clients (Standard: {SOCKET_PATH}, leer = aus)."
+)
+parser.add_argument(
+    '--archive-dir',
+    default='.',
+    help="Verzeichnis für die gespeicherten Texte und Audiodateien (Standard: aktuelles Verzeichnis)."
+)
+parser.add_argument(
+    '--archive-format',
+    choices=['wav'] + list(ARCHIVE_ENCODERS),
+    default=ARCHIVE_FORMAT,
+    help=f"Audioformat im Archiv (Standard: {ARCHIVE_FORMAT}, WAV wenn der Encoder fehlt)."
+)
+parser.add_argument(
+    '--lang-model',
+    default=None,
+    help="Pfad zum fastText-Sprachmodell, z.B. model/lid.176.ftz (917 kB statt 126 MB)."
+)
+parser.add_argument(
+    '--voice-concurrency',
+    type=int,
+    default=None,
+    help="Höchstens so viele Piper-Instanzen pro Stimme gleichzeitig (Standard: --workers)."
+)
+parser.add_argument(
+    '--production',
+    action='store_true',
+    help="Mit dem cheroot-WSGI-Server statt des Flask-Entwicklungsservers starten (pip install cheroot)."
+)
+parser.add_argument(
+    '--threads',
+    type=int,
+    default=SERVER_THREADS,
+    help=f"Anzahl der HTTP-Threads im --production-Modus (Standard: {SERVER_THREADS})."
+)
+parser.add_argument(
+    '--audio-sink',
+    default=AUDIO_SINK,
+    help="Audioausgabe: auto, pulse, alsa, aplay, null oder file:PFAD (Standard: auto)."
+)
+parser.add_argument(
+    '--warmup',
+    action='store_true',
+    help="Nach dem Laden mit jeder Stimme einmal einen kurzen Text synthetisieren."
+)
+parser.add_argument(
+    '--stream',
+    action='store_true',
+    help="Text satzweise synthetisieren und schon während der Synthese abspielen."
+)
+parser.add_argument(
+    '--parallel',
+    action='store_true',
+    help="Lange Texte in Abschnitte teilen und auf mehreren Piper-Workern gleichzeitig synthetisieren."
+)
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=PARALLEL_WORKERS,
+    help="Anzahl der Piper-Worker im parallelen Modus (Standard: Anzahl der CPU-Kerne)."
+)
+parser.add_argument(
+    '--mixed-languages',
+    action='store_true',
+    help="Die Sprache jedes Satzes einzeln erkennen und mit der passenden Stimme sprechen."
+)
+parser.add_argument(
+    '--barge-in',
+    choices=BARGE_IN_MODES,
+    default='queue',
+    help="Verhalten bei einer neuen Anfrage während der Wiedergabe (Standard: queue)."
+)
+parser.add_argument(
+    '--dedup-window',
+    type=float,
+    default=DEDUP_WINDOW_SECONDS,
+    help=f"Gleiche Anfragen innerhalb so vieler Sekunden zusammenfassen, 0 schaltet das ab (Standard: {DEDUP_WINDOW_SECONDS})."
+)
+parser.add_argument(
+    '--cache-size-mb',
+    type=int,
+    default=CACHE_MAX_MB,
+    help="Größe des Synthese-Caches im Speicher in MB (0 schaltet den Cache ab)."
+)
+parser.add_argument(
+    '--cache-dir',
+    default=None,
+    help="Verzeichnis, in dem der Synthese-Cache zusätzlich auf Platte liegt."
+)
+parser.add_argument(
+    '--cache-disk-size-mb',
+    type=int,
+    default=CACHE_DISK_MAX_MB,
+    help="Größe des Platten-Caches in MB."
+)
 args = parser.parse_args()
 
+if args.lang_model:
+    MODEL_PATH = args.lang_model
+print(f"Sprachmodell: {MODEL_PATH}")
+
+if args.save:
+    os.makedirs(args.archive_dir, exist_ok=True)
+    archive_index = ArchiveIndex(os.path.join(args.archive_dir, ARCHIVE_INDEX_NAME))
+    archive_writer = ArchiveWriter(args.archive_dir, args.archive_format, archive_index)
+else:
+    archive_index = None
+    archive_writer = None
+if archive_writer is not None:
+    atexit.register(archive_writer.flush)
+
+if args.cache_size_mb > 0 or args.cache_dir:
+    synthesis_cache = SynthesisCache(
+        args.cache_size_mb * 1024 * 1024,
+        disk_dir=args.cache_dir,
+        disk_max_bytes=args.cache_disk_size_mb * 1024 * 1024
+    )
+else:
+    synthesis_cache = None
+
 if args.save:
     print("Modus: Speichern & Ausgeben")
     # Dein Code hier
@@ -419,6 +2175,13 @@ else:
 app = Flask(__name__)
 CORS(app)
 
+audio_output = AudioOutput(create_audio_sink(args.audio_sink))
+atexit.register(audio_output.close)
+print(f"Audioausgabe: {audio_output.sink.name}")
+
+voice_pool = VoicePool(MODELS, args.voice_concurrency or max(args.workers, 1))
+atexit.register(voice_pool.close_all)
+
 # def slugify(text, max_length=50):
     # Ersetzt Umlaute und Sonderzeichen
 #     text = text.lower()
@@ -431,196 +2194,1159 @@ CORS(app)
 
 
 
-@app.route('/speak', methods=['POST'])
-def speak():
-    print("\n--- NEUE ANFRAGE EINGEGANGEN ---")
+def _request_option(name, default):
+    """Reads an optional per-request setting from the JSON body."""
+    data = request.get_json(silent=True)
+    return data.get(name, default) if isinstance(data, dict) else default
 
-    try:
-        # you can run e.g. with 'curl -k -X POST https://127.0.0.1:5002/speak'
-        if os.path.exists('/tmp/speak_server_input.txt'):
-            with open('/tmp/speak_server_input.txt', 'r') as f:
-                text_to_speak_easy = f.read()
-                print(f"Transkribiert: '{text_to_speak_easy}'")
-                os.remove('/tmp/speak_server_input.txt')
 
+# --- Spracherkennung ---
+class LanguageDetector:
+    """
+    Wraps the fastText model with a bounded input sample, a memo cache
+    keyed by text hash and a deterministic fallback.
+
+    Long texts are reduced to a few evenly spaced windows of at most
+    `max_chars` characters in total, so the cost stays constant. If the
+    best label with a voice is below `min_confidence`, or the text is too
+    short to judge, `default` (or the fallback passed to detect_many)
+    is returned.
+    """
+
+    def __init__(self, model_loader, languages, default: str = DEFAULT_LANG, max_chars: int = LANG_DETECT_MAX_CHARS,
+                 min_confidence: float = LANG_MIN_CONFIDENCE, cache_size: int = LANG_CACHE_SIZE):
+        self._model_loader = model_loader
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.languages = languages
+        self.default = default
+        self.max_chars = max_chars
+        self.min_confidence = min_confidence
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        """The fastText model, loaded on first use."""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = self._model_loader()
+        return self._model
+
+    def sample(self, text: str) -> str:
+        """Returns at most `max_chars` of `text` on a single line, as fastText expects."""
+        if len(text) > self.max_chars:
+            window = (self.max_chars - 2) // 3
+            middle = (len(text) - window) // 2
+            text = ' '.join((text[:window], text[middle:middle + window], text[-window:]))
+        return ' '.join(text.split())
+
+    def detect(self, text: str) -> str:
+        return self.detect_many([text])[0]
+
+    def detect_many(self, texts: list[str], fallback: str | None = None) -> list[str]:
+        """
+        Detects the language of several texts with one batched model call.
+        Texts that can't be judged get `fallback` (default: `default`).
+        """
+        with metrics.time('speak_language_detection_seconds'):
+            results = self._detect_many(texts)
+        fallback = fallback or self.default
+        return [fallback if lang_code is None else lang_code for lang_code in results]
+
+    def _detect_many(self, texts: list[str]) -> list[str | None]:
+        # None heißt "unsicher"; so steht im Cache nie eine Ausweichsprache
+        keys = [hashlib.sha1(text.encode('utf-8')).hexdigest() for text in texts]
+        results = [None] * len(texts)
+        todo = {}
+        with self._lock:
+            for index, key in enumerate(keys):
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    results[index] = self._cache[key]
+                else:
+                    todo.setdefault(key, []).append(index)
+
+        samples = {key: self.sample(texts[indexes[0]]) for key, indexes in todo.items()}
+        batch = [key for key, sample in samples.items() if len(sample) >= LANG_MIN_CHARS]
+        predicted = dict.fromkeys(samples)
+        if batch:
+            try:
+                labels, probabilities = self.model.predict([samples[key] for key in batch], k=3)
+                for key, key_labels, key_probabilities in zip(batch, labels, probabilities):
+                    predicted[key] = self._choose(key_labels, key_probabilities)
+            except Exception as e:
+                print(f"!!! FEHLER beim Erkennen der Sprache, verwende die Ausweichsprache: {e}")
+
+        with self._lock:
+            for key, indexes in todo.items():
+                for index in indexes:
+                    results[index] = predicted[key]
+                self._cache[key] = predicted[key]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return results
+
+    def _choose(self, labels, probabilities) -> str | None:
+        for label, probability in zip(labels, probabilities):
+            lang_code = label.replace('__label__', '')
+            if lang_code in self.languages and probability >= self.min_confidence:
+                return lang_code
+        return None
+
+
+def _load_language_model():
+    # fastText kann .bin und das quantisierte .ftz direkt laden. Einen mmap-Loader gibt es
+    # nicht, jeder Prozess hält das ganze Modell im Speicher; weniger braucht nur das .ftz-Modell.
+    import fasttext
+    return fasttext.load_model(MODEL_PATH)
+
+
+language_detector = LanguageDetector(_load_language_model, MODELS)
+
+
+def detect_language(text: str) -> str:
+    """Detects the language code of `text` (DEFAULT_LANG if unsure)."""
+    lang_code = language_detector.detect(text)
+    print(f"Erkannte Sprache für den Text: '{lang_code}'")
+    return lang_code
+
+
+def select_model_path(lang_code: str) -> str:
+    """Returns the voice for `lang_code`, falling back to German."""
+    if lang_code == 'de' and 'de' in MODELS:
+        print("-> Deutsches Modell wird verwendet.")
+        return MODELS['de']
+    if lang_code == 'en' and 'en' in MODELS:
+        print("-> Englisches Modell wird verwendet.")
+        return MODELS['en']
+    # Fallback-Lösung: Wenn die Sprache nicht erkannt wird oder kein Modell dafür existiert,
+    # nehmen wir ein Standardmodell (z.B. Deutsch).
+    print(f"WARNUNG: Kein Modell für Sprache '{lang_code}' gefunden. Fallback auf Deutsch.")
+    return MODELS['de']
+
+
+# --- Auftragswarteschlange ---
+def complete_prefix_length(text: str, start: int = 0) -> int:
+    """
+    Returns where the complete sentences in `text` end, but not before
+    `start`. The sentence still being written and an open ``` code block
+    stay behind, so they are cleaned only once they are whole.
+    """
+    end = start
+    for match in SESSION_BOUNDARY_RE.finditer(text, start):
+        if text.count('```', 0, match.end()) % 2 == 0:
+            end = match.end()
+    return end
+
+
+class SpeakSession:
+    """
+    Text that arrives piece by piece while it is still being written, e.g.
+    a Gemini answer. Every sentence is cleaned and handed to the synthesis
+    as soon as it is complete; the rest waits for more text or the end.
+    """
+
+    END = object()
+
+    def __init__(self, stages: list[str], idle_timeout: float = SESSION_IDLE_TIMEOUT):
+        self.stages = stages
+        self.idle_timeout = idle_timeout
+        self.text = ''
+        self.released = 0
+        self.sentences = []
+        self.spoken = 0
+        self.closed = False
+        self.last_append = time.monotonic()
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+
+    def append(self, text: str, final: bool = False, offset: int | None = None):
+        """
+        Adds `text` to the end. `offset`, if given, must be the number of
+        characters received so far, so lost or reordered pieces are noticed.
+        Raises ValueError if the session is closed or the offset is wrong.
+        """
+        with self._lock:
+            if self.closed:
+                raise ValueError("Sitzung ist bereits geschlossen")
+            if offset is not None and offset != len(self.text):
+                raise ValueError(f"Erwartet wurde offset {len(self.text)}, nicht {offset}")
+            self.text += text
+            self.last_append = time.monotonic()
+            end = len(self.text) if final else complete_prefix_length(self.text, self.released)
+            if end > self.released:
+                cleaned = clean_for_tts(self.text[self.released:end], self.stages)
+                for sentence in split_sentences(cleaned):
+                    self.sentences.append(sentence)
+                    self._ready.put(sentence)
+                self.released = end
+            if final:
+                self.closed = True
+                self._ready.put(self.END)
+
+    def abort(self):
+        """Ends the session at once; text that was not spoken yet is dropped."""
+        with self._lock:
+            self.closed = True
+        self._ready.put(self.END)
+
+    def iter_sentences(self):
+        """Yields the sentences as they become complete, until the session ends."""
+        while True:
+            try:
+                sentence = self._ready.get(timeout=1)
+            except queue.Empty:
+                if not self.closed and time.monotonic() - self.last_append > self.idle_timeout:
+                    print(f"Sitzung seit {self.idle_timeout} s ohne neuen Text, wird geschlossen.")
+                    try:
+                        self.append('', final=True)
+                    except ValueError:
+                        pass
+                continue
+            if sentence is self.END:
+                return
+            yield sentence
+
+    def to_dict(self) -> dict:
+        return {
+            "closed": self.closed,
+            "received_chars": len(self.text),
+            "released_chars": self.released,
+            "sentences": len(self.sentences),
+            "sentences_spoken": self.spoken,
+        }
+
+
+class SpeakJob:
+    """One /speak request, tracked from the queue through playback."""
+
+    def __init__(self, text: str, stages: list[str], options: dict):
+        self.id = uuid.uuid4().hex
+        self.text = text
+        self.stages = stages
+        self.options = options
+        self.state = 'queued'
+        self.progress = 0.0
+        self.message = None
+        self.result = {}
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self.cancellation = Cancellation()
+        self.audio = AudioRing()
+        self.playback = None
+        self.key = self.dedup_key(text, stages, options)
+        self.duplicates = 0
+        # Bei /sessions: die Sitzung, aus der der Text nach und nach kommt
+        self.session = None
+
+    @staticmethod
+    def dedup_key(text: str, stages: list[str], options: dict) -> str:
+        """Identifies requests that would produce the same speech: same text up to whitespace, same settings."""
+        normalized = ' '.join(text.split())
+        return hashlib.sha256(json.dumps([normalized, stages, options], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def attach_playback(self, playback):
+        """Remembers the job's Playback, so its position shows up in the status."""
+        self.playback = playback
+
+    def finish(self, state: str | None = None):
+        if state is not None:
+            self.update(state)
+        self.finished = time.time()
+        self.audio.close()
+        self.done.set()
+
+    def cancel(self):
+        """Stops the job; a queued job is skipped, a running one is interrupted."""
+        if not self.done.is_set():
+            self.cancellation.cancel()
+
+    def update(self, state: str, progress: float | None = None):
+        self.state = state
+        if progress is not None:
+            self.progress = progress
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "progress": round(self.progress, 3),
+            "position": round(self.playback.position, 3) if self.playback is not None else None,
+            "message": self.message,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "duplicates": self.duplicates,
+            **({"session": self.session.to_dict()} if self.session is not None else {}),
+            **self.result,
+        }
+
+
+class JobScheduler:
+    """
+    Runs SpeakJobs one after another on a background thread, so /speak
+    can answer immediately. Finished jobs are kept for status queries
+    until more than `history` of them have piled up.
+
+    A new job can be queued behind the running one ('queue'), replace it
+    and everything still waiting ('preempt'), or be dropped while the
+    server is busy ('drop').
+
+    A job identical to one still running or waiting, or to one that
+    finished less than `dedup_window` seconds ago, is not queued again;
+    submit() returns the existing job instead.
+    """
+
+    # Nur erfolgreiche oder noch laufende Aufträge nehmen Duplikate auf
+    DEDUP_FAILED_STATES = ('cancelled', 'error', 'dropped', 'rejected')
+
+    def __init__(self, runner, history: int = JOB_HISTORY, dedup_window: float = DEDUP_WINDOW_SECONDS):
+        self.runner = runner
+        self.history = history
+        self.dedup_window = dedup_window
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()
+        self._current = None
+        self._closed = False
+        self._lock = threading.Lock()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, job: SpeakJob, barge_in: str = 'queue', dedup: bool = True) -> SpeakJob:
+        with self._lock:
+            finished = [job_id for job_id, old in self._jobs.items() if old.done.is_set()]
+            for job_id in finished[:max(0, len(finished) - self.history)]:
+                del self._jobs[job_id]
+
+            original = self._find_duplicate(job) if dedup else None
+            if original is not None:
+                original.duplicates += 1
+                print(f"Gleicher Text wie Auftrag {original.id}, wird nicht erneut gesprochen.")
+                return original
+
+            if self._closed:
+                print(f"Auftrag {job.id} abgelehnt, der Server fährt herunter.")
+                job.finish('rejected')
+            elif barge_in == 'drop' and self._busy():
+                print(f"Auftrag {job.id} verworfen, es wird gerade gesprochen.")
+                job.finish('dropped')
+            elif barge_in == 'preempt':
+                self._cancel_pending()
+            self._jobs[job.id] = job
+        if not job.done.is_set():
+            self._queue.put(job)
+        return job
+
+    def stop_all(self) -> int:
+        """Cancels the running job and all waiting jobs; returns how many were hit."""
+        with self._lock:
+            return self._cancel_pending()
+
+    def shutdown(self, timeout: float | None = None) -> bool:
+        """
+        Stops accepting new jobs and waits until the running and queued ones
+        are finished. Returns False if `timeout` ran out first.
+        """
+        with self._lock:
+            self._closed = True
+            pending = [job for job in self._jobs.values() if not job.done.is_set()]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for job in pending:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not job.done.wait(remaining):
+                return False
+        return True
+
+    def _find_duplicate(self, job: SpeakJob) -> SpeakJob | None:
+        if self.dedup_window <= 0:
+            return None
+        cutoff = time.time() - self.dedup_window
+        for old in reversed(self._jobs.values()):
+            # Ein abgebrochener Auftrag kann noch laufen, spricht aber nichts mehr
+            if old.key != job.key or old.state in self.DEDUP_FAILED_STATES or old.cancellation.is_cancelled():
+                continue
+            if not old.done.is_set() or old.finished >= cutoff:
+                return old
+        return None
+
+    def _busy(self) -> bool:
+        return any(not job.done.is_set() for job in self._jobs.values())
+
+    def _cancel_pending(self) -> int:
+        pending = [job for job in self._jobs.values() if not job.done.is_set()]
+        for job in pending:
+            print(f"Auftrag {job.id} wird abgebrochen.")
+            job.cancel()
+        return len(pending)
+
+    def get(self, job_id: str) -> SpeakJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                self._current = job
+            job.started = time.time()
+            try:
+                job.cancellation.check()
+                self.runner(job)
+                job.update('done', 1.0)
+                print("--- ANFRAGE ERFOLGREICH BEENDET ---")
+            except Exception as e:
+                if job.cancellation.is_cancelled():
+                    job.update('cancelled')
+                    print(f"Auftrag {job.id} abgebrochen.")
+                else:
+                    job.update('error')
+                    job.message = str(e)
+                    print(f"!!! EIN ALLGEMEINER FEHLER IST AUFGETRETEN: {e}")
+                    # Die traceback-Library hilft bei der Fehlersuche
+                    import traceback
+                    traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._current = None
+                job.finish()
+
+
+def replay_archived(job: SpeakJob):
+    """Plays the archived recording `job.options['replay_id']`."""
+    entry = archive_index.get(job.options['replay_id'])
+    audio = load_archived_audio(entry['audio_path'], entry['sample_rate']) if entry else None
+    if not audio:
+        raise RuntimeError("Aufnahme nicht lesbar")
+    job.update('playing')
+    job.audio.start(entry['sample_rate'])
+    play_pcm_chunks([audio], entry['sample_rate'], cancellation=job.cancellation, started=job.started,
+                    consumers=[job.audio.write], on_playback=job.attach_playback)
+    job.result.update({"replayed": entry['id'], "file_saved": entry['audio_path'], "language": entry['language']})
+
+
+def run_session_job(job: SpeakJob):
+    """
+    Speaks a SpeakSession sentence by sentence while its text is still
+    arriving. The language is detected once SESSION_DETECT_MIN_CHARS of
+    text are complete, or on everything if the session ends earlier.
+    """
+    session = job.session
+    job.cancellation.add_callback(session.abort)
+    try:
+        job.update('waiting')
+        sentences = session.iter_sentences()
+        leading = []
+        for sentence in sentences:
+            leading.append(sentence)
+            if sum(len(text) for text in leading) >= SESSION_DETECT_MIN_CHARS:
+                break
+        job.cancellation.check()
+        if not leading:
+            print("Sitzung ohne Text geschlossen.")
+            return
+        text_ready_at = time.time()
+
+        job.update('detecting')
+        lang_code = detect_language(' '.join(leading))
+        model_path = select_model_path(lang_code)
+        model_name = Path(model_path).name
+        job.result["language"] = lang_code
+        job.result["model"] = model_name
+        metrics.inc('speak_requests_total', language=lang_code, model=model_name)
+
+        def on_chunk(done_chunks):
+            session.spoken = done_chunks
+            job.update('playing', done_chunks / len(session.sentences))
+
+        with voice_pool.lease(model_path) as engines:
+            engine = engines[0]
+            job.update('playing')
+            job.audio.start(engine.sample_rate)
+            consumers = [job.audio.write]
+            archive_stream = None
+            if archive_writer is not None:
+                archive_stream = archive_writer.open_stream(
+                    '', engine.sample_rate, create_slug(' '.join(leading), min_word_len=5), {"language": lang_code, "model": model_name})
+                consumers.append(archive_stream.write)
+            try:
+                played_bytes = play_pcm_chunks(
+                    iter_synthesized(engine, itertools.chain(leading, sentences), cancellation=job.cancellation),
+                    engine.sample_rate, on_chunk, job.cancellation, text_ready_at, consumers, job.attach_playback
+                )
+            except BaseException:
+                if archive_stream is not None:
+                    archive_stream.abort()
+                raise
+    finally:
+        job.cancellation.remove_callback(session.abort)
+        job.text = session.text
+
+    if archive_stream is not None:
+        if played_bytes:
+            spoken_text = ' '.join(session.sentences)
+            archive_stream.text = session.text
+            archive_stream.metadata.update(text_hash=ArchiveIndex.text_hash(spoken_text), spoken_text=spoken_text)
+            archive_stream.finish()
+            job.result["file_saved"] = archive_stream.audio_path
         else:
-            data = request.get_json()
-            if not data or 'text' not in data:
-                return jsonify({"status": "error", "message": "Kein Text übermittelt"}), 400
-            text_to_speak = data['text']
+            archive_stream.abort()
+    if not played_bytes:
+        raise PiperError("Leere Audioausgabe von Piper")
+    print(f"Sitzung beendet: {len(session.sentences)} Abschnitte gesprochen.")
+
+
+def run_speak_job(job: SpeakJob):
+    """Cleans, detects the language, synthesizes, plays and saves one job."""
+    if job.session is not None:
+        run_session_job(job)
+        return
+    if 'replay_id' in job.options:
+        replay_archived(job)
+        return
+
+    job.update('cleaning')
+    cleaning_timings = {}
+    text_to_speak_easy = clean_for_tts(job.text, job.stages, cleaning_timings)
+    job.result["cleaning_ms"] = cleaning_timings
+    print(f"Reinigung (ms): {cleaning_timings}")
+    print(f"Erfolgreich geparster Text: {text_to_speak_easy[:80]}...")
+
+    #################################################################
+
+    # SCHRITT 1: SPRACHE ERKENNEN
+    job.update('detecting')
+    lang_code = detect_language(text_to_speak_easy)
+    segments = []
+    if job.options.get('mixed_languages', args.mixed_languages):
+        segments = segment_by_language(text_to_speak_easy, lang_code)
+        job.result["languages"] = [segment_lang for segment_lang, _ in segments]
+
+    # SCHRITT 2: MODELL-PFAD DYNAMISCH AUSWÄHLEN
+    selected_model_path = select_model_path(lang_code)
+    job.result["language"] = lang_code
+    job.result["model"] = Path(selected_model_path).name
+    metrics.inc('speak_requests_total', language=lang_code, model=job.result["model"])
+
+    #################################################################
+
+    # 1. Piper: Audio mit der bereits geladenen Stimme erzeugen
+    # 2. Die rohen Daten direkt an 'aplay' zur Wiedergabe senden
+    job.update('synthesizing')
+    with contextlib.ExitStack() as leases:
+        engine = leases.enter_context(voice_pool.lease(selected_model_path))[0]
+        sample_rate = engine.sample_rate
+        stream = job.options.get('stream', args.stream)
+        parallel = job.options.get('parallel', args.parallel)
+
+        def on_chunk(done_chunks, total_chunks):
+            job.update('playing', done_chunks / total_chunks)
+
+        # Gleicher Text mit gleicher Stimme schon im Archiv? Dann die Aufnahme abspielen.
+        # Nur wenn der Cache ihn nicht schon hat (kein Decoder-Aufruf) und nicht beim Streaming,
+        # das nicht auf das Dekodieren der ganzen Aufnahme warten soll.
+        text_hash = ArchiveIndex.text_hash(text_to_speak_easy)
+        model_name = Path(selected_model_path).name
+        cached = synthesis_cache is not None and synthesis_cache.contains(
+            SynthesisCache.make_key(text_to_speak_easy, engine.model_path, engine.sample_rate))
+        if archive_index is not None and not segments and not stream and not parallel and not cached:
+            recording = archive_index.find_recording(text_hash, model_name)
+            recorded_audio = load_archived_audio(recording['audio_path'], recording['sample_rate']) if recording else None
+            if recorded_audio:
+                print(f"Aufnahme {recording['id']} aus dem Archiv wird abgespielt.")
+                job.update('playing')
+                job.audio.start(recording['sample_rate'])
+                play_pcm_chunks([recorded_audio], recording['sample_rate'], cancellation=job.cancellation,
+                                started=job.started, consumers=[job.audio.write], on_playback=job.attach_playback)
+                job.result["replayed"] = recording['id']
+                job.result["file_saved"] = recording['audio_path']
+                return
+
+        def play(chunks, rate: int, total_chunks: int) -> int:
+            """
+            Plays the chunks while live listeners and the archive get the very
+            same chunks at the same time; returns how many bytes were played.
+            """
+            job.audio.start(rate)
+            consumers = [job.audio.write]
+            archive_stream = None
+            # 3. Speichern der Audiodatei im Hintergrund, während gespielt wird
+            if archive_writer is not None:
+                ###############################
+                slug = create_slug(text_to_speak_easy, min_word_len=5)
+                ###############################
+                archive_stream = archive_writer.open_stream(job.text, rate, slug, {
+                    "language": lang_code if len(segments) < 2 else '+'.join(sorted({lang for lang, _ in segments})),
+                    "model": model_name,
+                    "text_hash": text_hash,
+                    "spoken_text": text_to_speak_easy,
+                })
+                consumers.append(archive_stream.write)
+            try:
+                played_bytes = play_pcm_chunks(
+                    chunks, rate, lambda done_chunks: on_chunk(done_chunks, total_chunks),
+                    job.cancellation, job.started, consumers, job.attach_playback
+                )
+            except BaseException:
+                if archive_stream is not None:
+                    archive_stream.abort()
+                raise
+            if archive_stream is not None:
+                if played_bytes:
+                    archive_stream.finish()
+                    job.result["file_saved"] = archive_stream.audio_path
+                else:
+                    archive_stream.abort()
+            return played_bytes
+
+        if len({segment_lang for segment_lang, _ in segments}) > 1:
+            # Jede Stimme nur einmal ausleihen, auch wenn mehrere Sprachen auf sie fallen
+            voices = {selected_model_path: engine}
+            for model_path in {select_model_path(segment_lang) for segment_lang, _ in segments} - set(voices):
+                voices[model_path] = leases.enter_context(voice_pool.lease(model_path))[0]
+            engines = {
+                segment_lang: voices[select_model_path(segment_lang)]
+                for segment_lang, _ in segments
+            }
+            sample_rate = max(segment_engine.sample_rate for segment_engine in engines.values())
+            print(f"Gemischte Sprachen: {len(segments)} Abschnitte, {len(engines)} Stimmen.")
+            played_bytes = play(
+                iter_routed_synthesized(segments, engines, sample_rate, job.cancellation), sample_rate, len(segments))
+        elif parallel:
+            chunks = group_sentences(split_sentences(text_to_speak_easy))
+            # Weitere Kopien nur, wenn sie gerade frei sind; sonst reicht die eigene
+            engines = [engine] + leases.enter_context(
+                voice_pool.lease(selected_model_path, min(args.workers, len(chunks)) - 1, block=False))
+            print(f"Paralleler Modus: {len(chunks)} Abschnitte auf {len(engines)} Workern.")
+            played_bytes = play(iter_parallel_synthesized(engines, chunks, job.cancellation), engine.sample_rate, len(chunks))
+        elif stream:
+            sentences = split_sentences(text_to_speak_easy)
+            print(f"Streaming-Modus: {len(sentences)} Abschnitte.")
+            played_bytes = play(
+                iter_synthesized(engine, sentences, cancellation=job.cancellation), engine.sample_rate, len(sentences))
+        else:
+            raw_audio_data = synthesize_cached(engine, text_to_speak_easy, job.cancellation)
+            played_bytes = 0
+            if raw_audio_data:
+                print("Audio erfolgreich generiert, starte Wiedergabe...")
+                played_bytes = play([raw_audio_data], engine.sample_rate, 1)
+
+    if not played_bytes:
+        raise PiperError("Leere Audioausgabe von Piper")
+
+    print("Wiedergabe beendet.")
+    if synthesis_cache is not None:
+        cache_stats = synthesis_cache.stats()
+        print(f"Cache: {cache_stats['hits']} Treffer, {cache_stats['misses']} Fehlschläge")
 
-            text_to_speak_easy = text_to_speak
-            text_to_speak_easy = clean_text_for_tts(text_to_speak_easy)
-            text_to_speak_easy = clean_interactive_text_for_tts(text_to_speak_easy)
-            text_to_speak_easy = clean_text_with_libraries(text_to_speak_easy)
-            text_to_speak_easy = clean_python_code_for_tts(text_to_speak_easy)
 
+job_scheduler = JobScheduler(run_speak_job, dedup_window=args.dedup_window)
+metrics.gauge('speak_queue_depth', "Wartende Aufträge.", job_scheduler.queue_depth)
 
 
-        print(f"Erfolgreich geparster Text: {text_to_speak_easy[:80]}...")
+def submit_speak_request(data) -> tuple[dict, int, SpeakJob | None]:
+    """
+    Validates a speak request (from HTTP or the local socket) and queues it.
+    Returns the response body, its HTTP status code and the job.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('text'), str):
+        return {"status": "error", "message": "Kein Text übermittelt"}, 400, None
+    try:
+        stages = select_cleaning_stages(data.get('stages'), data.get('skip_stages'))
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400, None
+
+    barge_in = data.get('barge_in', args.barge_in)
+    if barge_in not in BARGE_IN_MODES:
+        return {"status": "error", "message": f"'barge_in' muss einer von {BARGE_IN_MODES} sein"}, 400, None
+
+    options = {
+        name: data[name]
+        for name in ('stream', 'parallel', 'mixed_languages')
+        if data.get(name) is not None
+    }
+    dedup = data.get('dedup', True)
+    if not isinstance(dedup, bool):
+        return {"status": "error", "message": "'dedup' muss true oder false sein"}, 400, None
+
+    new_job = SpeakJob(data['text'], stages, options)
+    job = job_scheduler.submit(new_job, barge_in, dedup)
+    if job is not new_job:
+        metrics.inc('speak_deduplicated_total')
+        return {"status": "duplicate", "job_id": job.id, "state": job.state, "status_url": f"/jobs/{job.id}"}, 202, job
+    if job.state == 'dropped':
+        return {"status": "dropped", "job_id": job.id}, 409, job
+    if job.state == 'rejected':
+        return {"status": "rejected", "job_id": job.id, "message": "Server fährt herunter"}, 503, job
+    print(f"Auftrag {job.id} eingereiht ({job_scheduler.queue_depth()} in der Warteschlange).")
+    return {"status": "queued", "job_id": job.id, "status_url": f"/jobs/{job.id}"}, 202, job
 
 
-        #################################################################
+@app.route('/speak', methods=['POST'])
+def speak():
+    # you can run e.g. with 'curl -k -X POST https://127.0.0.1:5002/speak -d '{"text": "Hallo"}' -H 'Content-Type: application/json'
+    print("\n--- NEUE ANFRAGE EINGEGANGEN ---")
+    body, status_code, job = submit_speak_request(request.get_json(silent=True))
 
-        # SCHRITT 1: SPRACHE ERKENNEN (dieser Block kommt jetzt nach oben)
+    # Alte Clients können weiterhin auf das Ende der Wiedergabe warten
+    if status_code == 202 and _request_option('wait', False):
+        job.done.wait()
+        if job.state == 'error':
+            return jsonify({"status": "error", **job.to_dict()}), 500
+        if job.state == 'cancelled':
+            return jsonify({"status": "cancelled", **job.to_dict()})
+        return jsonify({"status": "success", **job.to_dict()})
 
+    return jsonify(body), status_code
+
+
+# --- Lokaler Socket ---
+class SpeakSocketHandler(socketserver.StreamRequestHandler):
+    """
+    One connection = one request. The client sends a single JSON line like
+    the /speak body and gets JSON lines back: first the acknowledgement,
+    then, with "follow": true, every state change until the job is over.
+    """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Nur eine Verbindungsprobe (speak_file.py), keine Anfrage
+            return
+        print("\n--- NEUE ANFRAGE ÜBER DEN SOCKET ---")
         try:
-            predictions = model.predict(text_to_speak_easy)
-            lang_code = predictions[0][0].replace('__label__', '')
-            print(f"Erkannte Sprache für den Text: '{lang_code}'")
-        except Exception as e:
+            data = json.loads(line)
+        except ValueError:
+            self._send({"status": "error", "message": "Ungültiges JSON"})
+            return
+        body, _, job = submit_speak_request(data)
+        self._send(body)
+        if job is None or body["status"] not in ("queued", "duplicate") or not data.get('follow'):
+            return
+
+        last = None
+        try:
+            while True:
+                finished = job.done.wait(SOCKET_FOLLOW_INTERVAL)
+                current = (job.state, round(job.progress, 2))
+                if current != last:
+                    last = current
+                    self._send({"status": "progress", "state": job.state, "progress": current[1]})
+                if finished:
+                    self._send({"status": job.state, **job.to_dict()})
+                    return
+        except OSError:
+            # Client hat nicht auf das Ende gewartet, der Auftrag läuft trotzdem weiter
+            pass
 
-            for _ in range(5):
-                try:
-                    # Generate a random start index
-                    start = random.randint(0, len(text_to_speak_easy))
+    def _send(self, message: dict):
+        self.wfile.write((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+        self.wfile.flush()
 
-                    # Calculate the remaining length of the text
-                    remaining_length = len(text_to_speak_easy) - start
 
-                    # Generate a random length for the substring, between 1 and the remaining length
-                    length = random.randint(1, remaining_length)
+def start_socket_server(path: str):
+    """Serves SpeakSocketHandler on a Unix domain socket only the current user can use."""
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.ThreadingUnixStreamServer(path, SpeakSocketHandler)
+    server.daemon_threads = True
+    os.chmod(path, 0o600)
+    atexit.register(lambda: os.path.exists(path) and os.remove(path))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Lokaler Socket bereit: {path}")
+    return server
 
-                    # Extract the random part
-                    random_part = text_to_speak_easy[start:start + length]
 
-                    predictions = model.predict(random_part)
-                    lang_code = predictions[0][0].replace('__label__', '')
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_scheduler.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unbekannter Auftrag"}), 404
+    return jsonify({"status": "success", **job.to_dict()})
 
-                    break  # break out of the loop if no exception occurs
-                except Exception as e:
-                    print(f"An exception occurred: {e}")
-                    print(f"!!! FEHLER beim erkennen der Sprache. TODO: Use random parts many times ???? Error : {e}")
-                    lang_code = 'de'
-                    print(f"!!! Workaround. its set to de")
-                    # continue to the next iteration if an exception occurs
 
+@app.route('/playback', methods=['GET'])
+def playback_status():
+    """What the audio output is playing right now and how far it got."""
+    return jsonify({"status": "success", **audio_output.status()})
 
 
+@app.route('/jobs/<job_id>/audio', methods=['GET'])
+def job_audio(job_id):
+    """
+    Streams the audio of a job live as a WAV while it is being played,
+    starting with what is still buffered.
+    """
+    job = job_scheduler.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unbekannter Auftrag"}), 404
+    sample_rate = job.audio.wait_started()
+    if sample_rate is None:
+        return jsonify({"status": "error", "message": "Auftrag hat kein Audio erzeugt", "state": job.state}), 409
 
+    def generate():
+        yield wav_stream_header(sample_rate)
+        yield from job.audio.listen()
 
-        # SCHRITT 2: MODELL-PFAD DYNAMISCH AUSWÄHLEN
-        if lang_code == 'de' and 'de' in MODELS:
-            selected_model_path = MODELS['de']
-            print("-> Deutsches Modell wird verwendet.")
-        elif lang_code == 'en' and 'en' in MODELS:
-            selected_model_path = MODELS['en']
-            print("-> Englisches Modell wird verwendet.")
-        else:
-            # Fallback-Lösung: Wenn die Sprache nicht erkannt wird oder kein Modell dafür existiert,
-            # nehmen wir ein Standardmodell (z.B. Deutsch).
-            print(f"WARNUNG: Kein Modell für Sprache '{lang_code}' gefunden. Fallback auf Deutsch.")
-            selected_model_path = MODELS['de']
+    return Response(stream_with_context(generate()), mimetype='audio/wav', headers={
+        "X-Sample-Rate": str(sample_rate),
+        "Cache-Control": "no-store",
+    })
 
-        #################################################################
 
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = job_scheduler.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unbekannter Auftrag"}), 404
+    job.cancel()
+    return jsonify({"status": "success", **job.to_dict()})
 
 
+@app.route('/stop', methods=['POST'])
+def stop():
+    stopped = job_scheduler.stop_all()
+    print(f"Wiedergabe gestoppt, {stopped} Aufträge abgebrochen.")
+    return jsonify({"status": "success", "cancelled": stopped})
 
-        if args.save:
-            # 1. Piper-Prozess: Audio im Speicher erzeugen (output-raw)
-            # Dadurch fangen wir die rohen Audiodaten in 'stdout' auf.
-            # piper_cmd = ["piper-tts", "--model", MODEL_PATH, "--output-raw"]
-            piper_cmd = ["piper-tts", "--model", selected_model_path, "--output-raw"]
-            piper_process = subprocess.Popen(
-                piper_cmd,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
 
-        piper_cmd = ["piper-tts", "--model", selected_model_path, "--output-raw"]
-        piper_process = subprocess.Popen(
-            piper_cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
+@app.route('/sessions', methods=['POST'])
+def open_session():
+    """
+    Opens a session for text that is still being written. The answer's
+    session_id is also its job_id; text follows via POST /sessions/<id>.
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "message": "Erwartet wird ein JSON-Objekt"}), 400
+    try:
+        stages = select_cleaning_stages(data.get('stages'), data.get('skip_stages'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    barge_in = data.get('barge_in', args.barge_in)
+    if barge_in not in BARGE_IN_MODES:
+        return jsonify({"status": "error", "message": f"'barge_in' muss einer von {BARGE_IN_MODES} sein"}), 400
+
+    job = SpeakJob('', stages, {})
+    job.session = SpeakSession(stages)
+    job_scheduler.submit(job, barge_in, dedup=False)
+    if job.state == 'dropped':
+        return jsonify({"status": "dropped", "job_id": job.id}), 409
+    if job.state == 'rejected':
+        return jsonify({"status": "rejected", "job_id": job.id, "message": "Server fährt herunter"}), 503
+    print(f"Sitzung {job.id} geöffnet.")
+    return jsonify({"status": "open", "session_id": job.id, "session_url": f"/sessions/{job.id}",
+                    "job_id": job.id, "status_url": f"/jobs/{job.id}"}), 201
+
+
+@app.route('/sessions/<session_id>', methods=['POST'])
+def append_to_session(session_id):
+    """
+    Appends {"text": "..."} to a session; complete sentences are spoken
+    right away. "final": true speaks the rest and closes the session.
+    """
+    job = job_scheduler.get(session_id)
+    if job is None or job.session is None:
+        return jsonify({"status": "error", "message": "Unbekannte Sitzung"}), 404
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "message": "Erwartet wird ein JSON-Objekt"}), 400
+    text = data.get('text', '')
+    offset = data.get('offset')
+    if not isinstance(text, str) or not (offset is None or isinstance(offset, int)):
+        return jsonify({"status": "error", "message": "'text' muss ein String und 'offset' eine Zahl sein"}), 400
+    if job.done.is_set():
+        return jsonify({"status": job.state, **job.to_dict()}), 409
+    try:
+        job.session.append(text, bool(data.get('final')), offset)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e), **job.to_dict()}), 409
+    return jsonify({"status": "closed" if job.session.closed else "open", **job.to_dict()})
+
 
-        raw_audio_data, stderr = piper_process.communicate(input=text_to_speak_easy.encode('utf-8'))
 
-        if piper_process.returncode != 0:
-            print("!!! FEHLER von Piper-TTS:", stderr.decode('utf-8'))
-            return jsonify({"status": "error", "message": "Piper-TTS Fehler"}), 500
 
-        if not raw_audio_data:
-            print("!!! FEHLER: Piper hat keine Audiodaten erzeugt.")
-            return jsonify({"status": "error", "message": "Leere Audioausgabe von Piper"}), 500
 
-        print("Audio erfolgreich generiert, starte Wiedergabe...")
 
 
 
-        # 2. Audio-Prozess: Die rohen Daten direkt an 'aplay' zur Wiedergabe senden
-        aplay_cmd = f"aplay -r {SAMPLE_RATE} -f S16_LE -t raw -"
-        aplay_process = subprocess.Popen(shlex.split(aplay_cmd), stdin=subprocess.PIPE)
-        aplay_process.communicate(input=raw_audio_data)
 
-        print("Wiedergabe beendet.")
 
-        # 3. Speichern der Audiodatei mit Zeitstempel
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
-        ###############################
-        ###############################
-        ###############################
-        slug = create_slug(text_to_speak_easy, min_word_len=5)
-        ###############################
-        ###############################
-        ###############################
 
-        output_filename = f"{timestamp}_{slug}.wav"
 
-        output_filename_txt = f"{timestamp}_{slug}.txt"
 
-        # output_filename_txt = f"{timestamp}.txt"
 
 
-        with open(output_filename_txt, "w") as text_file:
-            text_file.write(text_to_speak)
 
 
-        try:
-            with wave.open(output_filename, 'wb') as wf:
-                wf.setnchannels(CHANNELS)
-                wf.setsampwidth(SAMPLE_WIDTH)
-                wf.setframerate(SAMPLE_RATE)
-                wf.writeframes(raw_audio_data)
-            print(f"Audio erfolgreich in '{output_filename}' gespeichert.")
-        except Exception as e:
-            print(f"!!! FEHLER beim Speichern der WAV-Datei: {e}")
-            # Dies ist kein kritischer Fehler, also läuft der Request weiter
 
-        print("--- ANFRAGE ERFOLGREICH BEENDET ---")
-        return jsonify({"status": "success", "file_saved": output_filename})
 
-    except Exception as e:
-        print(f"!!! EIN ALLGEMEINER FEHLER IST AUFGETRETEN: {e}")
-        # Die traceback-Library hilft bei der Fehlersuche
-        import traceback
-        traceback.print_exc()
-        return jsonify({"status": "error", "message": str(e)}), 500
 
 
 
+# --- Start im Hintergrund ---
+class StartupStatus:
+    """
+    Loads the heavy parts (language model, cleaning libraries, voices) in
+    parallel background threads and records how far each one got.
+    """
 
+    def __init__(self):
+        self._components = {}
+        self._lock = threading.Lock()
 
+    def run(self, name: str, func):
+        with self._lock:
+            self._components[name] = {"state": "loading", "seconds": None}
+        threading.Thread(target=self._load, args=(name, func), daemon=True).start()
 
+    def _load(self, name: str, func):
+        start = time.perf_counter()
+        try:
+            func()
+            state = "ready"
+            print(f"Geladen: {name} ({time.perf_counter() - start:.2f} s)")
+        except Exception as e:
+            state = "error"
+            print(f"!!! FEHLER beim Laden von {name}: {e}")
+        with self._lock:
+            self._components[name] = {"state": state, "seconds": round(time.perf_counter() - start, 3)}
+
+    def state(self) -> str:
+        """'error' if any part failed to load, else 'loading' or 'ready'."""
+        with self._lock:
+            states = {component["state"] for component in self._components.values()}
+        if "error" in states:
+            return "error"
+        return "loading" if "loading" in states else "ready"
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {name: dict(component) for name, component in self._components.items()}
+
+
+startup_status = StartupStatus()
+
+
+def start_background_loading(warmup: bool):
+    """Starts loading everything at once; requests that arrive earlier simply wait for their part."""
+    startup_status.run('language_model', lambda: language_detector.model)
+    # Importiert markdown_it, pygments (inkl. Python-Lexer) und bs4
+    startup_status.run('cleaning', lambda: clean_text_with_libraries("```python\n# a\n```\n<b>b</b>"))
+    for lang, model_path in MODELS.items():
+        def load_voice(lang=lang, model_path=model_path):
+            # Anfragen für diese Stimme warten, bis sie geladen (und aufgewärmt) ist
+            with voice_pool.lease(model_path, warmup=WARMUP_TEXTS.get(lang, "Hello.") if warmup else None):
+                pass
+        startup_status.run(f"voice_{lang}", load_voice)
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness check: 200 once all models are loaded (and warmed up), 503
+    while they are still loading or if one of them failed to load. The
+    server accepts requests either way.
+    """
+    state = startup_status.state()
+    return jsonify({
+        "status": state,
+        "components": startup_status.snapshot(),
+        "queue_depth": job_scheduler.queue_depth(),
+    }), 200 if state == "ready" else 503
 
 
+def write_endpoint_file(url: str, socket_path: str | None):
+    """Announces the running server to local clients, removed again at exit."""
+    with open(ENDPOINT_FILE, 'w') as f:
+        json.dump({"url": url, "socket": socket_path or None, "pid": os.getpid()}, f)
 
+    def remove_endpoint_file():
+        try:
+            with open(ENDPOINT_FILE, 'r') as f:
+                if json.load(f).get('pid') == os.getpid():
+                    os.remove(ENDPOINT_FILE)
+        except (OSError, ValueError):
+            pass
 
+    atexit.register(remove_endpoint_file)
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics in the text exposition format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    if synthesis_cache is None:
+        return jsonify({"status": "disabled"})
+    return jsonify({"status": "success", **synthesis_cache.stats()})
 
 
+@app.route('/stages', methods=['GET'])
+def cleaning_stages():
+    timings = stage_timings.snapshot()
+    return jsonify({
+        "status": "success",
+        "stages": [{"name": name, **timings.get(name, {})} for name in CLEANING_STAGES]
+    })
 
 
+@app.route('/archive', methods=['GET'])
+def archive_search():
+    """Searches the archive, e.g. /archive?q=docker&lang=en&since=2025-01-01&limit=20"""
+    if archive_index is None:
+        return jsonify({"status": "disabled"})
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"status": "error", "message": "'limit' muss eine Zahl sein"}), 400
+    entries = archive_index.search(
+        request.args.get('q'), request.args.get('lang'),
+        request.args.get('since'), request.args.get('until'), limit
+    )
+    return jsonify({"status": "success", "entries": entries})
+
+
+@app.route('/archive/<int:utterance_id>/audio', methods=['GET'])
+def archive_audio(utterance_id):
+    entry = archive_index.get(utterance_id) if archive_index is not None else None
+    if entry is None or not os.path.exists(entry['audio_path']):
+        return jsonify({"status": "error", "message": "Aufnahme nicht gefunden"}), 404
+    return send_file(entry['audio_path'])
+
+
+@app.route('/archive/<int:utterance_id>/replay', methods=['POST'])
+def archive_replay(utterance_id):
+    """Plays an archived recording again through the normal job queue."""
+    entry = archive_index.get(utterance_id) if archive_index is not None else None
+    if entry is None or not os.path.exists(entry['audio_path']):
+        return jsonify({"status": "error", "message": "Aufnahme nicht gefunden"}), 404
+    barge_in = _request_option('barge_in', args.barge_in)
+    if barge_in not in BARGE_IN_MODES:
+        return jsonify({"status": "error", "message": f"'barge_in' muss einer von {BARGE_IN_MODES} sein"}), 400
+    job = job_scheduler.submit(SpeakJob(entry['spoken_text'] or '', [], {'replay_id': utterance_id}), barge_in)
+    if job.state == 'dropped':
+        return jsonify({"status": "dropped", "job_id": job.id}), 409
+    if job.state == 'rejected':
+        return jsonify({"status": "rejected", "job_id": job.id, "message": "Server fährt herunter"}), 503
+    return jsonify({"status": "queued", "job_id": job.id, "status_url": f"/jobs/{job.id}"}), 202
+
+
+@app.route('/synthesize', methods=['POST'])
+def synthesize():
+    """
+    Streams the synthesized audio back to the caller instead of playing it.
+    The response is a chunked WAV (or raw PCM with "format": "pcm") that
+    grows sentence by sentence while Piper is still working.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('text'), str):
+        return jsonify({"status": "error", "message": "Kein Text übermittelt"}), 400
+    audio_format = data.get('format', 'wav')
+    if audio_format not in ('wav', 'pcm'):
+        return jsonify({"status": "error", "message": "'format' muss 'wav' oder 'pcm' sein"}), 400
+    try:
+        stages = select_cleaning_stages(data.get('stages'), data.get('skip_stages'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    text = clean_for_tts(data['text'], stages)
+    sentences = split_sentences(text)
+    if not sentences:
+        return jsonify({"status": "error", "message": "Nach der Reinigung ist kein Text übrig"}), 400
+    lang_code = detect_language(text)
+    model_path = select_model_path(lang_code)
+    sample_rate = _read_voice_sample_rate(model_path)
+    print(f"Streaming an den Client: {len(sentences)} Abschnitte.")
+
+    def generate():
+        cancellation = Cancellation()
+        finished = False
+        try:
+            if audio_format == 'wav':
+                yield wav_stream_header(sample_rate)
+            # Die Stimme bleibt für die ganze Antwort ausgeliehen
+            with voice_pool.lease(model_path) as engines:
+                for chunk in iter_synthesized(engines[0], sentences, cancellation=cancellation):
+                    yield chunk
+            finished = True
+        finally:
+            # Client hat die Verbindung getrennt: laufende Synthese nicht zu Ende rechnen
+            if not finished:
+                cancellation.cancel()
+
+    mimetype = 'audio/wav' if audio_format == 'wav' else 'application/octet-stream'
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers={
+        "X-Language": lang_code,
+        "X-Sample-Rate": str(sample_rate),
+        "X-Sample-Format": "S16_LE",
+        "Cache-Control": "no-store",
+    })
+
+
+# --- Serverbetrieb ---
+def make_http_server(host: str, port: int, ssl_config, production: bool, threads: int):
+    """
+    Builds the HTTP server and returns its (serve, stop) functions.
+    --production uses cheroot's thread-pooled WSGI server, otherwise
+    Werkzeug's threaded development server is used.
+    """
+    if production:
+        try:
+            from cheroot import wsgi
+        except ImportError:
+            print("WARNUNG: cheroot nicht installiert (pip install cheroot), nutze den Flask-Entwicklungsserver.")
+        else:
+            server = wsgi.Server((host, port), app, numthreads=threads)
+            if ssl_config:
+                from cheroot.ssl.builtin import BuiltinSSLAdapter
+                server.ssl_adapter = BuiltinSSLAdapter(*ssl_config)
+            print(f"Produktionsmodus: cheroot mit {threads} Threads.")
+            return server.safe_start, server.stop
+
+    from werkzeug.serving import make_server
+    server = make_server(host, port, app, threaded=True, ssl_context=ssl_config)
+    return server.serve_forever, server.shutdown
 
 
+def install_shutdown_handler(stop_server):
+    """
+    On SIGTERM or Ctrl+C: refuse new jobs, let the running and queued ones
+    finish (at most SHUTDOWN_DRAIN_TIMEOUT seconds), then stop the HTTP
+    server. A second signal cancels the remaining jobs right away.
+    """
+    draining = threading.Event()
+
+    def drain():
+        print("\nServer fährt herunter, warte auf laufende Aufträge...")
+        if not job_scheduler.shutdown(SHUTDOWN_DRAIN_TIMEOUT):
+            print("Zeit abgelaufen, verbleibende Aufträge werden abgebrochen.")
+            job_scheduler.stop_all()
+        stop_server()
 
+    def on_signal(signum, frame):
+        if draining.is_set():
+            print("Zweites Signal: Aufträge werden abgebrochen.")
+            job_scheduler.stop_all()
+            return
+        draining.set()
+        # Der Server muss weiterlaufen, während gewartet wird, also nicht im Signal-Handler blockieren
+        threading.Thread(target=drain, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
 
 
 if __name__ == '__main__':
@@ -648,6 +3374,17 @@ if __name__ == '__main__':
         ssl_config = None # Stelle sicher, dass die Konfiguration leer ist
         protocol = 'http'
 
-    # Schritt 2: Den Server EINMAL mit der fertigen Konfiguration starten
+    # Schritt 2: Sprachmodell, Bibliotheken und Stimmen parallel im Hintergrund laden,
+    # der Port ist trotzdem sofort offen
+    start_background_loading(args.warmup)
+
+    if args.socket:
+        start_socket_server(args.socket)
+    write_endpoint_file(f"{protocol}://127.0.0.1:{PORT}", args.socket)
+
+    # Schritt 3: Den Server EINMAL mit der fertigen Konfiguration starten
+    serve, stop_server = make_http_server('127.0.0.1', PORT, ssl_config, args.production, args.threads)
+    install_shutdown_handler(stop_server)
     print(f"Finaler Sprach-Server startet auf {protocol}://127.0.0.1:{PORT}")
-    app.run(host='127.0.0.1', port=PORT, ssl_context=ssl_config)
+    serve()
+    print("Server beendet.")
@@ -1,8 +1,8 @@
 // ==UserScript==
-// @name         Gemini to Piper TTS (v4.0 - Robust Final)
+// @name         Gemini to Piper TTS (v4.1 - Streaming)
 // @namespace    http://tampermonkey.net/
-// @version      4.0
-// @description  Liest die neueste, vollständig generierte Gemini-Antwort vor. Verhindert überlappende Stimmen.
+// @version      4.1
+// @description  Liest die neueste Gemini-Antwort vor, schon während sie geschrieben wird. Verhindert überlappende Stimmen.
 // @author       Seeh & AI
 // @match        https://gemini.google.com/app/*
 // @match        https://aistudio.google.com/prompts/*
@@ -16,14 +16,28 @@
 
     // --- KONFIGURATION ---
     const SERVER_URL = 'https://localhost:5002/speak';
+    const SESSIONS_URL = 'https://localhost:5002/sessions';
     // Die Zeit in Millisekunden, die gewartet wird, nachdem sich der Text nicht mehr ändert.
     // Ein höherer Wert ist sicherer, um überlappende Stimmen zu vermeiden.
     const DEBOUNCE_DELAY = 2000; // 2 Sekunden
+    // Vorlesen, während Gemini noch schreibt: jeder fertige Satz wird sofort gesprochen.
+    // false = wie früher die ganze Antwort erst nach DEBOUNCE_DELAY senden.
+    const STREAM_WHILE_WRITING = true;
+    // Höchstens so oft (Millisekunden) wird neuer Text an den Server geschickt
+    const STREAM_INTERVAL = 300;
+    // Reinigungsstufen des Servers, die übersprungen werden sollen (z.B. ['libraries'] für reinen Text).
+    // Die verfügbaren Stufen und ihre Laufzeiten zeigt https://localhost:5002/stages
+    const SKIP_STAGES = [];
+    // Was der Server tut, wenn noch eine ältere Antwort gesprochen wird:
+    // 'preempt' = sofort abbrechen und die neue sprechen, 'queue' = hinten anstellen, 'drop' = neue verwerfen
+    const BARGE_IN = 'preempt';
     // --- ENDE KONFIGURATION ---
 
-    console.log('[Piper TTS v4.0] Skript aktiv. Modus: Robust Final.');
+    console.log(`[Piper TTS v4.1] Skript aktiv. Modus: ${STREAM_WHILE_WRITING ? 'Streaming' : 'Robust Final'}.`);
 
     let speechTimer = null;
+    // Die Sitzung der Antwort, die gerade mitgelesen wird
+    let session = null;
 
     // Diese Funktion wird bei jeder Änderung auf der Seite aufgerufen
     const onMutation = () => {
@@ -37,6 +51,10 @@
             return;
         }
 
+        if (STREAM_WHILE_WRITING) {
+            streamAnswer(latestAnswerContainer);
+        }
+
         // Setze den Timer bei jeder erkannten Textänderung zurück.
         clearTimeout(speechTimer);
 
@@ -50,9 +68,18 @@
                 return;
             }
 
+            // Wird die Antwort schon mitgelesen, nur noch den Rest schicken und die Sitzung schließen.
+            if (session && session.container === finalContainer && !session.failed) {
+                console.log('[Piper TTS v4.1] Antwort fertig. Schließe die Sitzung.');
+                finalContainer.dataset.ttsProcessed = 'true';
+                session.final = true;
+                pushToSession(session);
+                return;
+            }
+
             // Der Tab muss im Vordergrund sein, um zu sprechen.
             if (document.hidden) {
-                console.log('[Piper TTS v4.0] Tab im Hintergrund. Senden unterdrückt.');
+                console.log('[Piper TTS v4.1] Tab im Hintergrund. Senden unterdrückt.');
                 return;
             }
 
@@ -64,15 +91,104 @@
             if (finalFullText) {
                 // PRÜFUNG 2: Markiere den Container SOFORT als verarbeitet.
                 // Dies ist die wichtigste Sperre, um doppeltes Senden zu verhindern.
-                console.log('[Piper TTS v4.0] Timer abgelaufen. Markiere Container als verarbeitet.');
+                console.log('[Piper TTS v4.1] Timer abgelaufen. Markiere Container als verarbeitet.');
                 finalContainer.dataset.ttsProcessed = 'true';
 
-                console.log('[Piper TTS v4.0] Sende finale Antwort zum Server:', finalFullText);
+                console.log('[Piper TTS v4.1] Sende finale Antwort zum Server:', finalFullText);
                 sendTextToServer(finalFullText);
             }
         }, DEBOUNCE_DELAY);
     };
 
+    // Öffnet für eine neue Antwort eine Sitzung und schickt neuen Text höchstens alle STREAM_INTERVAL ms.
+    const streamAnswer = (container) => {
+        if (!session || session.container !== container) {
+            // Im Hintergrund keine neue Sitzung beginnen
+            if (document.hidden) return;
+            session = { container: container, id: null, sentText: '', inFlight: false, final: false, closed: false, failed: false, pushTimer: null };
+            openSession(session);
+            return;
+        }
+        if (!session.pushTimer) {
+            const current = session;
+            current.pushTimer = setTimeout(() => {
+                current.pushTimer = null;
+                pushToSession(current);
+            }, STREAM_INTERVAL);
+        }
+    };
+
+    // Der Text der Antwort, ungekürzt: ein Zeilenende am Schluss zeigt dem Server, dass der Satz fertig ist
+    const getAnswerText = (container) => {
+        const textElement = container.querySelector('ms-cmark-node, .model-response-text');
+        return textElement ? textElement.innerText : null;
+    };
+
+    const openSession = (s) => {
+        GM_xmlhttpRequest({
+            method: 'POST',
+            url: SESSIONS_URL,
+            data: JSON.stringify({ skip_stages: SKIP_STAGES, barge_in: BARGE_IN }),
+                          headers: { 'Content-Type': 'application/json' },
+                          onload: (response) => {
+                              if (response.status === 201) {
+                                  s.id = JSON.parse(response.responseText).session_id;
+                                  console.log(`[Piper TTS v4.1] Sitzung ${s.id} geöffnet.`);
+                                  pushToSession(s);
+                              } else {
+                                  // Ohne Sitzung wird die Antwort wie früher am Ende am Stück gesendet
+                                  console.error(`[Piper TTS v4.1] Sitzung abgelehnt: Status ${response.status}`, response);
+                                  s.failed = true;
+                              }
+                          },
+                          onerror: (response) => {
+                              console.error(`[Piper TTS v4.1] Server-Fehler. Läuft der Piper-Server? Ist die URL korrekt?`, response);
+                              s.failed = true;
+                          }
+        });
+    };
+
+    // Schickt den neuen Teil der Antwort; immer nur eine Anfrage gleichzeitig, damit die Reihenfolge stimmt.
+    const pushToSession = (s) => {
+        if (!s.id || s.inFlight || s.closed || s.failed) return;
+        const text = getAnswerText(s.container);
+        if (text === null) return;
+        let delta = '';
+        if (text.startsWith(s.sentText)) {
+            delta = text.slice(s.sentText.length);
+        } else {
+            // Gemini hat schon gesendeten Text beim Rendern umgebaut; der ist bereits gesprochen.
+            console.warn('[Piper TTS v4.1] Bereits gesendeter Text hat sich geändert, warte auf weiteren Text.');
+        }
+        const final = s.final;
+        if (!delta && !final) return;
+
+        s.inFlight = true;
+        GM_xmlhttpRequest({
+            method: 'POST',
+            url: `${SESSIONS_URL}/${s.id}`,
+            data: JSON.stringify({ text: delta, offset: s.sentText.length, final: final }),
+                          headers: { 'Content-Type': 'application/json' },
+                          onload: (response) => {
+                              s.inFlight = false;
+                              if (response.status >= 200 && response.status < 300) {
+                                  s.sentText += delta;
+                                  s.closed = final;
+                                  pushToSession(s);
+                              } else {
+                                  // z.B. abgebrochen durch eine neuere Antwort (preempt) oder POST /stop
+                                  console.warn(`[Piper TTS v4.1] Sitzung beendet: Status ${response.status}`, response.responseText);
+                                  s.closed = true;
+                              }
+                          },
+                          onerror: (response) => {
+                              s.inFlight = false;
+                              console.error(`[Piper TTS v4.1] Server-Fehler beim Senden an die Sitzung.`, response);
+                              s.closed = true;
+                          }
+        });
+    };
+
     // Eine Hilfsfunktion, um den richtigen Antwort-Container zu finden.
     const findLatestAnswerContainer = () => {
         // Gemini verwendet 'div.chat-turn-container.model' für die gesamte Box
@@ -88,20 +204,20 @@
         GM_xmlhttpRequest({
             method: 'POST',
             url: SERVER_URL,
-            data: JSON.stringify({ text: text }),
+            data: JSON.stringify({ text: text, skip_stages: SKIP_STAGES, barge_in: BARGE_IN }),
                           headers: { 'Content-Type': 'application/json' },
                           onload: (response) => {
                               if (response.status >= 200 && response.status < 300) {
-                                  console.log(`[Piper TTS v4.0] Server meldet Erfolg (${response.status})`);
+                                  console.log(`[Piper TTS v4.1] Server meldet Erfolg (${response.status})`);
                               } else {
-                                  console.error(`[Piper TTS v4.0] Server meldet Problem: Status ${response.status}`, response);
+                                  console.error(`[Piper TTS v4.1] Server meldet Problem: Status ${response.status}`, response);
                               }
                           },
                           onerror: (response) => {
-                              console.error(`[Piper TTS v4.0] Server-Fehler. Läuft der Piper-Server? Ist die URL korrekt?`, response);
+                              console.error(`[Piper TTS v4.1] Server-Fehler. Läuft der Piper-Server? Ist die URL korrekt?`, response);
                           },
                           ontimeout: () => {
-                              console.error(`[Piper TTS v4.0] Timeout. Der Server antwortet nicht.`);
+                              console.error(`[Piper TTS v4.1] Timeout. Der Server antwortet nicht.`);
                           }
         });
     };